@@ -8,7 +8,12 @@ Defines the public API to the httpcache module.
 
 __version__ = '0.1.3'
 
-from .cache import HTTPCache
+from .cache import HTTPCache, shared_cache
 from .adapter import CachingHTTPAdapter
+from .backends import RedisBackend
+from .policy import CacheRule
+from .memory import MemoryController
+from .eviction import EvictionPolicy, simulate
 
-__all__ = [HTTPCache, CachingHTTPAdapter]
+__all__ = [HTTPCache, CachingHTTPAdapter, RedisBackend, CacheRule,
+           MemoryController, EvictionPolicy, shared_cache, simulate]
@@ -5,8 +5,37 @@ adapter.py
 Contains an implementation of an HTTP adapter for Requests that is aware of the
 cache contained in this module.
 """
+import threading
+import weakref
+
 from requests.adapters import HTTPAdapter
-from .cache import HTTPCache
+from .cache import HTTPCache, shared_cache, _default
+
+# The cache built around each backend, keyed by the backend's id, so that
+# adapters given the same backend share one HTTPCache (and its lock) rather
+# than each wrapping it separately. Caches are held weakly, so a cache and its
+# backend are freed once no adapter uses them. While a cache is alive it holds
+# its backend, so the backend's id can't be reused.
+_backend_caches = weakref.WeakValueDictionary()
+_backend_caches_lock = threading.Lock()
+
+
+def _cache_for_backend(backend, capacity):
+    """
+    Returns the HTTPCache built around a backend, creating it if needed.
+    Raises ValueError if the cache already exists with a different capacity.
+    """
+    with _backend_caches_lock:
+        cache = _backend_caches.get(id(backend))
+
+        if cache is None:
+            cache = HTTPCache(capacity=capacity, backend=backend)
+            _backend_caches[id(backend)] = cache
+        elif capacity is not _default and capacity != cache.capacity:
+            raise ValueError("This backend is already used by a cache with "
+                             "capacity %r." % (cache.capacity,))
+
+        return cache
 
 
 class CachingHTTPAdapter(HTTPAdapter):
@@ -14,13 +43,37 @@ class CachingHTTPAdapter(HTTPAdapter):
     A HTTP-caching-aware Transport Adapter for Python Requests. The central
     portion of the API.
 
-    :param capacity: The maximum capacity of the backing cache.
+    By default each adapter has its own cache. To share a cache between
+    adapters (e.g. for ``http://`` and ``https://``), sessions or threads,
+    pass the same :class:`HTTPCache <httpcache.HTTPCache>` to each adapter,
+    or give each adapter the same cache name.
+
+    Backends are not safe to use from several caches at once, so adapters
+    given the same backend share the one cache built around it. Giving them
+    different capacities raises ValueError. To share a backend with other
+    code, share its :class:`HTTPCache <httpcache.HTTPCache>` instead.
+
+    :param capacity: (Optional) The maximum capacity of the backing cache.
+                     Defaults to ``DEFAULT_CAPACITY``, or to ``None``
+                     (unbounded) if a backend is given, since the backend
+                     manages the lifetime of its entries itself.
+    :param cache: (Optional) The :class:`HTTPCache <httpcache.HTTPCache>` to
+                  use, or the name of a process-wide shared cache.
+    :param backend: (Optional) The backend to build the adapter's cache on.
+                    Ignored if ``cache`` is given.
     """
-    def __init__(self, capacity=50, **kwargs):
+    def __init__(self, capacity=_default, cache=None, backend=None, **kwargs):
         super(CachingHTTPAdapter, self).__init__(**kwargs)
 
+        if cache is None and backend is not None:
+            cache = _cache_for_backend(backend, capacity)
+        elif cache is None:
+            cache = HTTPCache(capacity=capacity)
+        elif not isinstance(cache, HTTPCache):
+            cache = shared_cache(cache, capacity=capacity, backend=backend)
+
         #: The HTTP Cache backing the adapter.
-        self.cache = HTTPCache(capacity=capacity)
+        self.cache = cache
 
     def send(self, request, **kwargs):
         """
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+backends.py
+~~~~~~~~~~~
+
+Contains alternative backing stores for the HTTP cache. The default store is
+an in-process RecentOrderedDict: the objects here allow cache entries to be
+kept somewhere else, e.g. on a shared network server.
+"""
+import math
+import pickle
+import time
+from datetime import datetime
+
+from .structures import RecentOrderedDict
+from .utils import timestamp
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+class RedisBackend(object):
+    """
+    A backing store for :class:`HTTPCache <httpcache.HTTPCache>` that keeps
+    cache entries on a server that speaks the Redis protocol, allowing many
+    processes (and many machines) to share a single cache.
+
+    Entries are pickled before being sent to the server. Entries that have an
+    expiry date are given a server-side TTL derived from that date, so the
+    server discards them ``grace`` seconds after they go stale. Entries without
+    an expiry date (those kept only for conditional requests) get
+    ``default_ttl``. A cache using this backend raises ``grace`` to its
+    ``stale_retention``, so stale entries survive long enough to be
+    revalidated or served to requests with ``max-stale``.
+
+    A small in-process 'near cache' holds the most recently used entries for
+    ``near_cache_ttl`` seconds, so that the hottest keys don't need a network
+    round-trip on every lookup.
+
+    Because the server manages the lifetime of entries, caches using this
+    backend are unbounded (``capacity=None``) unless given a capacity. A
+    bounded cache counts and evicts entries across the whole shared keyspace,
+    which is slow and affects every process using the server.
+
+    :param client: (Optional) A ``redis.StrictRedis``-compatible client. If not
+                   provided, one is built from the connection parameters.
+    :param host: (Optional) The hostname of the Redis server.
+    :param port: (Optional) The port of the Redis server.
+    :param db: (Optional) The Redis database number.
+    :param max_connections: (Optional) The size of the connection pool.
+    :param prefix: (Optional) A string prepended to every key on the server.
+    :param default_ttl: (Optional) TTL in seconds for entries with no expiry.
+    :param grace: (Optional) How long, in seconds, to keep entries on the
+                  server after they expire.
+    :param near_cache_size: (Optional) The number of entries to hold locally.
+                            ``0`` disables the near cache.
+    :param near_cache_ttl: (Optional) How long, in seconds, a locally held
+                           entry may be used before it is fetched again.
+    """
+    def __init__(self, client=None, host='localhost', port=6379, db=0,
+                 max_connections=10, prefix='httpcache:', default_ttl=3600,
+                 grace=0, near_cache_size=128, near_cache_ttl=1.0):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("RedisBackend requires the redis package.")
+
+            pool = redis.ConnectionPool(host=host,
+                                        port=port,
+                                        db=db,
+                                        max_connections=max_connections)
+            client = redis.StrictRedis(connection_pool=pool)
+
+        #: The client used to talk to the server.
+        self.client = client
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.grace = grace
+        self.near_cache_size = near_cache_size
+        self.near_cache_ttl = near_cache_ttl
+
+        # The near cache maps keys to (entry, time fetched) tuples.
+        self._near = RecentOrderedDict()
+
+    def __getitem__(self, key):
+        entry = self._near_get(key)
+        if entry is not None:
+            return entry
+
+        data = self.client.get(self._server_key(key))
+        if data is None:
+            raise KeyError(key)
+
+        entry = pickle.loads(data)
+        self._near_set(key, entry)
+        return entry
+
+    def __setitem__(self, key, value):
+        ttl = self._ttl(value)
+
+        if ttl is not None and ttl <= 0:
+            self.__delitem__(key)
+            return
+
+        self.client.set(self._server_key(key), self._dumps(value), ex=ttl)
+        self._near_set(key, value)
+
+    def __delitem__(self, key):
+        self._near_discard(key)
+        if not self.client.delete(self._server_key(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if self._near_get(key) is not None:
+            return True
+
+        return bool(self.client.exists(self._server_key(key)))
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """
+        Returns every key stored on the server under this backend's prefix.
+        This walks the whole keyspace, so it should not be used on a hot path.
+        """
+        start = len(self.prefix)
+        keys = []
+
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            keys.append(key[start:])
+
+        return keys
+
+    def items(self):
+        found = self.get_many(self.keys())
+        return list(found.items())
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def clear(self):
+        keys = [self._server_key(key) for key in self.keys()]
+        if keys:
+            self.client.delete(*keys)
+        self._near.clear()
+
+    def get_many(self, keys):
+        """
+        Fetches many entries at once, using a single round-trip for any that
+        are not held in the near cache. Returns a dictionary of the entries
+        that were found, keyed by cache key.
+
+        :param keys: An iterable of cache keys.
+        """
+        found = {}
+        remote = []
+
+        for key in keys:
+            entry = self._near_get(key)
+            if entry is not None:
+                found[key] = entry
+            else:
+                remote.append(key)
+
+        if remote:
+            values = self.client.mget([self._server_key(k) for k in remote])
+
+            for key, data in zip(remote, values):
+                if data is None:
+                    continue
+
+                entry = pickle.loads(data)
+                self._near_set(key, entry)
+                found[key] = entry
+
+        return found
+
+    def set_many(self, mapping):
+        """
+        Stores many entries at once, pipelining the writes into a single
+        round-trip.
+
+        :param mapping: A dictionary of cache entries, keyed by cache key.
+        """
+        pipe = self.client.pipeline(transaction=False)
+
+        for key, value in mapping.items():
+            ttl = self._ttl(value)
+
+            if ttl is not None and ttl <= 0:
+                self._near_discard(key)
+                pipe.delete(self._server_key(key))
+                continue
+
+            pipe.set(self._server_key(key), self._dumps(value), ex=ttl)
+            self._near_set(key, value)
+
+        pipe.execute()
+
+    def delete_many(self, keys):
+        """
+        Removes many entries at once. Keys that aren't present are ignored.
+
+        :param keys: An iterable of cache keys.
+        """
+        keys = list(keys)
+        for key in keys:
+            self._near_discard(key)
+
+        if keys:
+            self.client.delete(*[self._server_key(key) for key in keys])
+
+    def _server_key(self, key):
+        return self.prefix + key
+
+    def _dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _ttl(self, value):
+        """
+        Works out the server-side TTL, in whole seconds, for a cache entry.
+        """
+        expiry = value.get('expiry')
+
+        if expiry is None:
+            return self.default_ttl
+
+        seconds = timestamp(expiry) - timestamp(datetime.utcnow()) + self.grace
+        return int(math.ceil(seconds))
+
+    def _near_get(self, key):
+        if not self.near_cache_size or key not in self._near:
+            return None
+
+        entry, fetched = self._near[key]
+        if time.time() - fetched > self.near_cache_ttl:
+            del self._near[key]
+            return None
+
+        return entry
+
+    def _near_set(self, key, entry):
+        if not self.near_cache_size:
+            return
+
+        self._near[key] = (entry, time.time())
+
+        while len(self._near) > self.near_cache_size:
+            self._near.popitem(last=False)
+
+    def _near_discard(self, key):
+        if key in self._near:
+            del self._near[key]
@@ -5,17 +5,46 @@ cache.py
 
 Contains the primary cache structure used in http-cache.
 """
-from .structures import RecentOrderedDict
+from .eviction import make_policy
+from .policy import CachePolicy
+from .structures import (RecentOrderedDict, InvalidationIndex, ExpiryBuckets,
+                         BodyStore)
 from .utils import (parse_date_header, build_date_header,
-                    expires_from_cache_control, url_contains_query)
-from datetime import datetime
+                    expires_from_cache_control, url_contains_query,
+                    compact_response, expand_response, tags_from_headers,
+                    timestamp, parse_cache_control, bodyless_response,
+                    request_directives, directive_seconds,
+                    gateway_timeout_response, MemoizedResponse)
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from datetime import datetime, timedelta
+import copy
+import functools
+import hashlib
+import hmac
+import os
+import pickle
+import threading
+
+try:  # Python 2
+    from urlparse import urlparse, urljoin
+except ImportError:  # Python 3
+    from urllib.parse import urlparse, urljoin
 
 
 # RFC 2616 specifies that we can cache 200 OK, 203 Non Authoritative,
 # 206 Partial Content, 300 Multiple Choices, 301 Moved Permanently and
 # 410 Gone responses. We don't cache 206s at the moment because we
-# don't handle Range and Content-Range headers.
-CACHEABLE_RCS = (200, 203, 300, 301, 410)
+# don't handle Range and Content-Range headers. RFC 7538 adds 308 Permanent
+# Redirect, which is cacheable in the same way as 301.
+CACHEABLE_RCS = (200, 203, 300, 301, 308, 410)
+
+# Permanent redirects. While these are cached, requests for their URLs can go
+# straight to the redirect target.
+PERMANENT_REDIRECT_RCS = (301, 308)
+
+# The longest chain of cached redirects we'll follow. This matches Requests.
+MAX_REDIRECT_HOPS = 30
 
 # Cacheable verbs.
 CACHEABLE_VERBS = ('GET', 'HEAD', 'OPTIONS')
@@ -26,6 +55,81 @@ CACHEABLE_VERBS = ('GET', 'HEAD', 'OPTIONS')
 # verbs. That works out well for us.
 NON_INVALIDATING_VERBS = CACHEABLE_VERBS
 
+# Request headers that identify the principal making a request.
+CREDENTIAL_HEADERS = ('Authorization', 'Proxy-Authorization', 'Cookie')
+
+# Headers that identify a particular version of a resource's body.
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified', 'Content-Length')
+
+# The Cache-Control directives that tell us how long a response is fresh for.
+FRESHNESS_DIRECTIVES = ('max-age', 'no-cache', 'no-store')
+
+# Suggested freshness lifetimes, in seconds, for negative caching of error
+# responses. Pass these (or your own) to HTTPCache as negative_ttls.
+DEFAULT_NEGATIVE_TTLS = {404: 60, 410: 300, 500: 5, 502: 5, 503: 5, 504: 5}
+
+# The capacity of a cache that keeps its entries in process. Caches built on a
+# backend are unbounded unless told otherwise, since the backend manages the
+# lifetime of its entries.
+DEFAULT_CAPACITY = 50
+
+# Marks a capacity that wasn't given.
+_default = object()
+
+# Unless told otherwise, the memoized payloads of a cache entry may use up to
+# this many times the size of its body, and at least MIN_MEMO_BUDGET bytes, to
+# allow for the fixed overhead of Python objects.
+DEFAULT_MEMO_FACTOR = 16
+MIN_MEMO_BUDGET = 64 * 1024
+
+# The possible results of evaluating a cache entry against a request: the entry
+# can be returned, it can be returned if the server says it's unmodified, or it
+# has expired and must be thrown away.
+HIT = 'hit'
+CONDITIONAL = 'conditional'
+EXPIRED = 'expired'
+
+# The first bytes of every snapshot file, identifying the format and version.
+SNAPSHOT_MAGIC = b'HTTPCACHE-SNAPSHOT-1\n'
+
+# The process-wide registry of named caches, shared between adapters, sessions
+# and threads.
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def shared_cache(name='default', **kwargs):
+    """
+    Returns the process-wide :class:`HTTPCache <HTTPCache>` registered under
+    ``name``, creating it if it doesn't exist yet. Every caller asking for the
+    same name gets the same cache, so all of them share one bounded store.
+
+    :param name: (Optional) The name of the cache.
+    :param kwargs: (Optional) Arguments used to create the cache if it doesn't
+                   exist yet. They are ignored if it does.
+    """
+    with _shared_caches_lock:
+        try:
+            cache = _shared_caches[name]
+        except KeyError:
+            cache = HTTPCache(**kwargs)
+            cache._shared = True
+            _shared_caches[name] = cache
+
+    return cache
+
+
+def synchronized(method):
+    """
+    Decorates a method of the HTTPCache so that it runs while holding the
+    cache's lock.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class HTTPCache(object):
     """
@@ -37,171 +141,1334 @@ class HTTPCache(object):
     of the public API for users who feel the need for more control. This API
     may change in a minor version increase. Be warned.
 
-    :param capacity: (Optional) The maximum capacity of the HTTP cache.
+    :param capacity: (Optional) The maximum capacity of the HTTP cache. If
+                     ``None``, the cache is unbounded, which is useful when
+                     the backend manages the lifetime of entries itself.
+                     Defaults to ``DEFAULT_CAPACITY``, or to ``None`` if a
+                     backend is given.
+    :param backend: (Optional) The store used to hold cache entries, e.g. a
+                    :class:`RedisBackend <httpcache.backends.RedisBackend>`.
+                    Defaults to an in-process store.
+    :param sweep_batch: (Optional) The maximum number of expired entries to
+                        remove each time the cache is used. ``0`` disables
+                        sweeping on use.
+    :param heuristic_fraction: (Optional) For responses with a Last-Modified
+                               header but no explicit freshness information,
+                               the fraction of the time since the resource was
+                               last modified for which the response is
+                               considered fresh. ``0`` disables heuristic
+                               freshness.
+    :param heuristic_max_age: (Optional) The longest time, in seconds, for
+                              which a response may be heuristically fresh.
+    :param heuristic_disabled_hosts: (Optional) An iterable of hostnames for
+                                     which heuristic freshness is not used.
+    :param negative_ttls: (Optional) A dictionary mapping error status codes
+                          to the time, in seconds, for which responses with
+                          that status are cached when they carry no explicit
+                          freshness information. See ``DEFAULT_NEGATIVE_TTLS``.
+                          Error responses are cached without their bodies.
+    :param negative_max_ttl: (Optional) The longest time, in seconds, for which
+                             an error response is cached, whatever its headers
+                             say.
+    :param dedupe_bodies: (Optional) Whether to hold identical response bodies
+                          in memory only once. Only useful with the default
+                          in-process backend.
+    :param rules: (Optional) An iterable of
+                  :class:`CacheRule <httpcache.policy.CacheRule>` objects that
+                  override the caching decisions for matching URLs.
+    :param stale_retention: (Optional) How long, in seconds, to keep entries
+                            after they expire, so that they can be revalidated
+                            or served to requests with ``max-stale``.
+    :param memory_controller: (Optional) A
+                              :class:`MemoryController <httpcache.memory.MemoryController>`
+                              that adjusts the capacity of the cache to memory
+                              pressure.
+    :param private_mode: (Optional) If True, responses to requests that carry
+                         credentials (an Authorization or Cookie header) are
+                         cached in a private partition for those credentials,
+                         and only used to answer requests with the same
+                         credentials. Responses marked private are then only
+                         stored if the request carried credentials. Caches
+                         with a backend, or from shared_cache(), never store
+                         unpartitioned private responses.
+    :param partition_capacity: (Optional) The maximum number of entries in
+                               each private partition.
+    :param partition_secret: (Optional) The key used to hash credentials into
+                             partition names, as bytes. Defaults to a random
+                             key, so partitions don't survive a restart, and
+                             private entries are left out of snapshots.
+    :param eviction_policy: (Optional) The policy used to choose which entries
+                            to evict when the cache is full: one of ``'lru'``,
+                            ``'slru'``, ``'arc'`` or ``'lfu'``, or an
+                            :class:`EvictionPolicy <httpcache.eviction.EvictionPolicy>`.
+                            If not provided, unexpiring entries are evicted
+                            first, then the least recently used.
+    :param memoize_payloads: (Optional) If set, cached responses remember their
+                             decoded text and parsed JSON after the first use.
+                             With ``'readonly'``, the parsed JSON is shared and
+                             can't be changed. With ``'copy'``, each call to
+                             ``json()`` returns a copy. Memos are dropped when
+                             the entry is revalidated or removed, and count
+                             towards a rule's ``max_size``.
+    :param memo_max_size: (Optional) The most bytes the memos of each entry
+                          may use. Defaults to ``DEFAULT_MEMO_FACTOR`` times
+                          the size of the entry's body, or
+                          ``MIN_MEMO_BUDGET``, whichever is larger.
     """
-    def __init__(self, capacity=50):
+    def __init__(self, capacity=_default, backend=None, sweep_batch=10,
+                 heuristic_fraction=0.1, heuristic_max_age=86400,
+                 heuristic_disabled_hosts=(), negative_ttls=None,
+                 negative_max_ttl=300, dedupe_bodies=False, rules=None,
+                 stale_retention=0, memory_controller=None,
+                 private_mode=False, partition_capacity=None,
+                 partition_secret=None, eviction_policy=None,
+                 memoize_payloads=None, memo_max_size=None):
+        if capacity is _default:
+            capacity = DEFAULT_CAPACITY if backend is None else None
+
+        if memoize_payloads not in (None, 'readonly', 'copy'):
+            raise ValueError("memoize_payloads must be None, 'readonly' or "
+                             "'copy'.")
+
         #: The maximum capacity of the HTTP cache. When this many cache entries
         #: end up in the cache, the oldest entries are removed.
         self.capacity = capacity
 
         #: The cache backing store. Cache entries are stored here as key-value
-        #: pairs. The key is the URL used to retrieve the cached response. The
+        #: pairs. The key is the URL used to retrieve the cached response,
+        #: prefixed by the request method for methods other than GET. The
         #: value is a python dict, which stores three objects: the response
         #: (keyed off of 'response'), the retrieval or creation date (keyed off
         #: of 'creation') and the cache expiry date (keyed off of 'expiry').
         #: This last value may be None.
-        self._cache = RecentOrderedDict()
+        self._cache = backend if backend is not None else RecentOrderedDict()
+
+        #: Whether the cache may be shared between principals: true when the
+        #: backend may be shared with other processes, or when the cache is
+        #: shared through shared_cache().
+        self._shared = backend is not None
 
+        #: An index over the keys in the cache, used to find related entries
+        #: for bulk invalidation. The index only knows about entries stored
+        #: through this object.
+        self._index = InvalidationIndex()
+
+        #: The number of expired entries to sweep on each store or retrieve.
+        self.sweep_batch = sweep_batch
+
+        #: The expiry times of the entries in the cache, grouped into buckets
+        #: so that expired entries can be found without walking the cache.
+        self._expiries = ExpiryBuckets()
+
+        #: Settings for heuristic freshness, as described in RFC 7234.
+        self.heuristic_fraction = heuristic_fraction
+        self.heuristic_max_age = heuristic_max_age
+        self.heuristic_disabled_hosts = set(host.lower() for host in
+                                            heuristic_disabled_hosts)
+
+        #: Settings for negative caching of error responses.
+        self.negative_ttls = dict(negative_ttls or {})
+        self.negative_max_ttl = negative_max_ttl
+
+        #: The cached permanent redirects, mapping each redirecting URL to a
+        #: tuple of the redirect target and the redirect's expiry date.
+        self._redirects = {}
+
+        #: The deduplicating store for response bodies, if enabled, and a map
+        #: from each cache key to the digest of the body it references.
+        self._bodies = BodyStore() if dedupe_bodies else None
+        self._body_refs = {}
+
+        #: The controller adjusting the capacity to memory pressure, if any.
+        self.memory_controller = memory_controller
+
+        #: How long to keep entries after they expire.
+        self.stale_retention = stale_retention
+
+        # Backends that expire entries themselves must keep them this long too.
+        if hasattr(self._cache, 'grace'):
+            self._cache.grace = max(self._cache.grace, stale_retention)
+
+        #: Settings for partitioning private responses by principal.
+        self.private_mode = private_mode
+        self.partition_capacity = partition_capacity
+        self._partition_secret = partition_secret or os.urandom(32)
+        self._persistent_partitions = partition_secret is not None
+
+        #: The keys in each private partition, in order of use, and a map
+        #: from each private key to its partition.
+        self._partitions = {}
+        self._key_partitions = {}
+
+        #: The policy choosing which entries to evict, if any. It tracks the
+        #: entries stored through this object.
+        self.eviction_policy = None
+        if eviction_policy is not None:
+            self.eviction_policy = make_policy(eviction_policy, capacity)
+
+        #: How decoded payloads are memoized, if at all, and the memoizing
+        #: responses in the cache, by key.
+        self.memoize_payloads = memoize_payloads
+        self.memo_max_size = memo_max_size
+        self._memoized = {}
+
+        #: The compiled cache policy rules, if any.
+        self._policy = CachePolicy(rules) if rules else None
+
+        self._lock = threading.RLock()
+        self._sweeper = None
+        self._sweeper_stop = None
+
+    @synchronized
     def store(self, response):
         """
         Takes an HTTP response object and stores it in the cache according to
         RFC 2616. Returns a boolean value indicating whether the response was
         cached or not.
 
+        Responses to HEAD requests refresh the headers of any cached response
+        to a GET for the same URL, rather than being stored separately.
+
         :param response: Requests :class:`Response <Response>` object to cache.
         """
-        # Define an internal utility function.
-        def date_header_or_default(header_name, default, response):
+        self._sweep(self.sweep_batch)
+
+        entry = self._build_entry(response)
+        if entry is None:
+            return False
+
+        key, entry = self._place_entry(response, entry)
+        self._insert(key, entry)
+
+        self._adjust_capacity()
+
+        return True
+
+    @synchronized
+    def store_many(self, responses):
+        """
+        Stores a batch of HTTP responses in the cache, writing all of the
+        cacheable ones to the backend in a single operation. Returns a list of
+        boolean values indicating whether each response was cached or not.
+
+        :param responses: An iterable of Requests :class:`Response <Response>` objects.
+        """
+        self._sweep(self.sweep_batch)
+
+        entries = {}
+        results = []
+
+        for response in responses:
+            entry = self._build_entry(response)
+            if entry is not None:
+                key, entry = self._place_entry(response, entry)
+                entries[key] = entry
+            results.append(entry is not None)
+
+        if entries:
+            self._set_many(entries)
+            self._adjust_capacity()
+
+        return results
+
+    @synchronized
+    def handle_304(self, response):
+        """
+        Given a 304 response, retrieves the cached entry. This unconditionally
+        returns the cached entry, so it can be used when the 'intelligent'
+        behaviour of retrieve() is not desired.
+
+        Returns None if there is no entry in the cache.
+
+        :param response: The 304 response to find the cached entry for. Should be a Requests :class:`Response <Response>`.
+        """
+        request = getattr(response, 'request', None)
+        method = request.method if request is not None else 'GET'
+        partition = self._partition(request)
+        key = self._key(method, response.url, partition)
+
+        try:
+            cached_response = self._cache[key]['response']
+        except KeyError:
+            cached_response = None
+
+        # A HEAD can be answered by the headers of a cached GET.
+        if cached_response is None and method == 'HEAD':
             try:
-                date_header = response.headers[header_name]
+                get_key = self._key('GET', response.url, partition)
+                cached_response = self._cache[get_key]['response']
             except KeyError:
-                value = default
+                pass
             else:
-                value = parse_date_header(date_header)
-            return value
+                cached_response = bodyless_response(cached_response)
 
-        if response.status_code not in CACHEABLE_RCS:
-            return False
+        # The entry has been revalidated: decode it afresh.
+        if isinstance(cached_response, MemoizedResponse):
+            cached_response.clear_memos()
+
+        return cached_response
+
+    @synchronized
+    def retrieve(self, request):
+        """
+        Retrieves a cached response if possible.
+
+        If there is a response that can be unconditionally returned (e.g. one
+        that had a Cache-Control header set), that response is returned. If
+        there is one that can be conditionally returned (if a 304 is returned),
+        applies an If-Modified-Since header to the request and returns None.
+
+        A HEAD request can be answered from a fresh cached response to a GET,
+        in which case a copy of that response without its body is returned.
+
+        :param request: The Requests :class:`PreparedRequest <PreparedRequest>` object.
+        """
+        self._sweep(self.sweep_batch)
+
+        if self.memory_controller is not None:
+            self._adjust_capacity()
+
+        if request.method not in NON_INVALIDATING_VERBS:
+            self._invalidate_url(request.url)
+            return None
+
+        # A bypassed request can't be answered from the cache, but a client
+        # asking for 'only-if-cached' still mustn't go to the network.
+        if self._bypasses(request):
+            if 'only-if-cached' in request_directives(request):
+                return gateway_timeout_response(request)
+            return None
+
+        self._follow_redirects(request)
+
+        for key in self._lookup_keys(request):
+            try:
+                cached_response = self._cache[key]
+            except KeyError:
+                continue
+
+            result, response = self._evaluate(request, key, cached_response)
+
+            if result == EXPIRED:
+                self._remove(key)
+            elif result == HIT:
+                self._touch(key)
+                return response
+            elif result is not None:
+                break
+
+        # The client doesn't want us to go to the network.
+        if 'only-if-cached' in request_directives(request):
+            return gateway_timeout_response(request)
+
+        return None
+
+    @synchronized
+    def retrieve_many(self, requests):
+        """
+        Looks up a batch of requests in the cache, fetching all of their cache
+        entries from the backend in a single operation.
+
+        Returns a tuple of three lists: ``(hits, misses, conditionals)``.
+        ``hits`` contains ``(request, response)`` pairs that can be answered
+        from the cache. ``misses`` contains requests that must be sent. And
+        ``conditionals`` contains requests that must be sent but that have had
+        an If-Modified-Since header applied, as for retrieve().
+
+        :param requests: An iterable of Requests :class:`PreparedRequest <PreparedRequest>` objects.
+        """
+        self._sweep(self.sweep_batch)
+
+        requests = list(requests)
+        hits, misses, conditionals = [], [], []
+        to_delete = set()
+        lookups = []
+
+        for request in requests:
+            keys = []
+
+            if request.method not in NON_INVALIDATING_VERBS:
+                to_delete.update(self._url_keys(request.url))
+            elif not self._bypasses(request):
+                self._follow_redirects(request)
+                keys = self._lookup_keys(request)
+
+            lookups.append(keys)
+
+        to_fetch = set(key for keys in lookups for key in keys)
+        entries = self._get_many(to_fetch - to_delete)
+
+        for request, keys in zip(requests, lookups):
+            result = None
+
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+
+                result, response = self._evaluate(request, key, entry)
+
+                if result == EXPIRED:
+                    to_delete.add(key)
+                    result = None
+                elif result is not None:
+                    break
+
+            if result != HIT and 'only-if-cached' in request_directives(request):
+                hits.append((request, gateway_timeout_response(request)))
+            elif result == HIT:
+                self._touch(key)
+                hits.append((request, response))
+            elif result == CONDITIONAL:
+                conditionals.append(request)
+            else:
+                misses.append(request)
+
+        if to_delete:
+            self._delete_many(to_delete)
+
+        return hits, misses, conditionals
+
+    @synchronized
+    def invalidate_prefix(self, url):
+        """
+        Removes every cache entry for this URL's path or any path below it, on
+        the same host, scheme and port. Query strings are ignored, so all
+        variants of each path are removed. Paths are matched a whole segment at
+        a time. Returns the number of entries removed.
+
+        :param url: The URL whose entries should be removed.
+        """
+        return self._delete_many(self._index.prefix(url))
+
+    @synchronized
+    def invalidate_host(self, host):
+        """
+        Removes every cache entry for URLs on the given host. Returns the number
+        of entries removed.
+
+        :param host: The hostname, without scheme or port.
+        """
+        return self._delete_many(self._index.host(host))
+
+    @synchronized
+    def invalidate_tag(self, tag):
+        """
+        Removes every cache entry whose response was tagged with the given tag
+        in a ``Surrogate-Key`` or ``Cache-Tag`` header. Returns the number of
+        entries removed.
+
+        :param tag: The tag whose entries should be removed.
+        """
+        return self._delete_many(self._index.tag(tag))
+
+    @synchronized
+    def sweep(self, limit=None):
+        """
+        Removes up to ``limit`` expired entries from the cache, or all of them
+        if ``limit`` is None. Returns the number of entries removed.
+
+        :param limit: (Optional) The maximum number of entries to remove.
+        """
+        return self._sweep(limit)
+
+    @synchronized
+    def start_sweeper(self, interval=1.0):
+        """
+        Starts a background thread that removes all expired entries from the
+        cache every ``interval`` seconds. Does nothing if the thread is already
+        running.
+
+        :param interval: (Optional) The time, in seconds, between sweeps.
+        """
+        if self._sweeper is not None:
+            return
+
+        stop = threading.Event()
+
+        def run():
+            while not stop.is_set():
+                stop.wait(interval)
+                if not stop.is_set():
+                    self.sweep()
+
+        self._sweeper_stop = stop
+        self._sweeper = threading.Thread(target=run, name='httpcache-sweeper')
+        self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        """
+        Stops the background sweeping thread, if it is running, and waits for
+        it to finish.
+        """
+        with self._lock:
+            sweeper, stop = self._sweeper, self._sweeper_stop
+            self._sweeper = self._sweeper_stop = None
+
+        if sweeper is None:
+            return
+
+        # Wait outside the lock: the thread takes it to sweep.
+        stop.set()
+        sweeper.join()
+
+    @synchronized
+    def memory_usage(self):
+        """
+        Reports the memory used by response bodies in the cache. Returns a
+        dictionary with two values: ``'bodies'``, the total size in bytes of
+        the bodies of all cache entries, and ``'stored'``, the number of bytes
+        actually held. These differ only when bodies are deduplicated.
+
+        If payloads are memoized, a third value, ``'memos'``, is the
+        approximate number of bytes used by the memos.
+        """
+        if self._bodies is not None:
+            usage = {'bodies': self._bodies.logical_bytes,
+                     'stored': self._bodies.stored_bytes}
+        else:
+            total = 0
+            for entry in self._cache.values():
+                total += len(getattr(entry['response'], 'content', None) or b'')
+
+            usage = {'bodies': total, 'stored': total}
+
+        if self.memoize_payloads is not None:
+            usage['memos'] = sum(response.memo_size for response
+                                 in self._memoized.values())
+
+        return usage
+
+    @synchronized
+    def dump(self, fileobj):
+        """
+        Writes the current contents of the cache to a binary file object, in a
+        format that can be read back by load(). Entries are written one at a
+        time, from least to most recently used, and entries that have already
+        expired are skipped. Returns the number of entries written.
+
+        Entries in private partitions are only written if the cache was given
+        a ``partition_secret``. Otherwise the partition names can't be worked
+        out again after a restart, so the entries would be unreachable.
+        Snapshots that include them hold authenticated responses in plain
+        form: protect them accordingly.
+
+        :param fileobj: A file object opened for writing in binary mode.
+        """
+        fileobj.write(SNAPSHOT_MAGIC)
+        now = datetime.utcnow()
+        count = 0
+
+        for key, entry in list(self._cache.items()):
+            if entry['expiry'] is not None and entry['expiry'] <= now:
+                continue
+
+            if 'partition' in entry and not self._persistent_partitions:
+                continue
+
+            meta = dict((k, v) for k, v in entry.items() if k != 'response')
+            record = (key, meta, compact_response(entry['response']))
+            pickle.dump(record, fileobj, pickle.HIGHEST_PROTOCOL)
+            count += 1
+
+        return count
+
+    @synchronized
+    def load(self, fileobj):
+        """
+        Reads a snapshot written by dump() into the cache. The snapshot is read
+        one entry at a time, so memory use doesn't depend on the size of the
+        snapshot. Entries that have expired since the snapshot was written are
+        skipped. Returns the number of entries loaded.
+
+        Snapshots are pickle data: only load snapshots from trusted sources.
+
+        :param fileobj: A file object opened for reading in binary mode.
+        """
+        if fileobj.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError("Not an httpcache snapshot.")
+
+        now = datetime.utcnow()
+        count = 0
+
+        while True:
+            try:
+                key, meta, data = pickle.load(fileobj)
+            except EOFError:
+                break
+
+            if meta['expiry'] is not None and meta['expiry'] <= now:
+                continue
+
+            entry = dict(meta)
+            response = expand_response(data)
+            entry['response'] = self._memoizing(response,
+                                                self._match_rule(response.url))
+            self._insert(key, entry)
+            self._adjust_capacity()
+            count += 1
+
+        return count
+
+    def _build_entry(self, response):
+        """
+        Decides, according to RFC 2616 and the cache policy, whether a response
+        may be cached. Returns the cache entry to store for it, or None if it
+        must not be cached.
+
+        :param response: Requests :class:`Response <Response>` object to cache.
+        """
+        negative = response.status_code in self.negative_ttls
+
+        if response.status_code not in CACHEABLE_RCS and not negative:
+            return None
 
         if response.request.method not in CACHEABLE_VERBS:
-            return False
+            return None
+
+        if not self._may_store_private(response):
+            return None
 
         url = response.url
         now = datetime.utcnow()
+        rule = self._match_rule(url)
+
+        if rule is not None:
+            if rule.bypass:
+                return None
+
+            if rule.max_size is not None:
+                body = getattr(response, 'content', None) or b''
+                if len(body) > rule.max_size:
+                    return None
 
         # Get the value of the 'Date' header, if it exists. If it doesn't, just
         # use now.
-        creation = date_header_or_default('Date', now, response)
+        creation = self._date_header(response, 'Date', now)
 
-        # Get the value of the 'Cache-Control' header, if it exists.
-        cc = response.headers.get('Cache-Control', None)
-        if cc is not None:
-            expiry = expires_from_cache_control(cc, now)
+        # A rule can fix the lifetime of a response, whatever it says.
+        if rule is not None and rule.ttl is not None:
+            expiry = now + timedelta(seconds=rule.ttl)
+        else:
+            cacheable, expiry = self._expiry_from_headers(response, now,
+                                                          creation, rule)
+            if not cacheable:
+                return None
 
-            # If the above returns None, we are explicitly instructed not to
-            # cache this.
+        # Error responses are only ever kept briefly, and never without an
+        # expiry: we have no validators to check them with.
+        if negative:
             if expiry is None:
-                return False
+                return None
 
-        # Get the value of the 'Expires' header, if it exists, and if we don't
-        # have anything from the 'Cache-Control' header.
-        if cc is None:
-            expiry = date_header_or_default('Expires', None, response)
+            expiry = min(expiry, now + timedelta(seconds=self.negative_max_ttl))
+            response = bodyless_response(response)
+
+        if rule is not None:
+            expiry = self._clamp_expiry(expiry, rule, now)
 
         # If the expiry date is earlier or the same as the Date header, don't
         # cache the response at all.
         if expiry is not None and expiry <= creation:
-            return False
+            return None
 
         # If there's a query portion of the url and it's a GET, don't cache
         # this unless explicitly instructed to.
         if expiry is None and response.request.method == 'GET':
             if url_contains_query(url):
-                return False
+                return None
 
-        self._cache[url] = {'response': response,
-                            'creation': creation,
-                            'expiry': expiry}
+        response = self._memoizing(response, rule)
 
-        self.__reduce_cache_count()
+        return {'response': response,
+                'creation': creation,
+                'expiry': expiry}
 
-        return True
+    def _memoizing(self, response, rule):
+        """
+        If payloads are memoized, builds a copy of a response that memoizes its
+        decoded payloads. The memos may use up to memo_max_size bytes, and no
+        more than is left of the matching rule's size limit once the body is
+        counted.
+        """
+        if self.memoize_payloads is None or not isinstance(response, Response):
+            return response
 
-    def handle_304(self, response):
+        body = response.content or b''
+
+        budget = self.memo_max_size
+        if budget is None:
+            budget = max(DEFAULT_MEMO_FACTOR * len(body), MIN_MEMO_BUDGET)
+
+        if rule is not None and rule.max_size is not None:
+            budget = min(budget, max(rule.max_size - len(body), 0))
+
+        return MemoizedResponse.from_response(response, self.memoize_payloads,
+                                              budget)
+
+    def _may_store_private(self, response):
         """
-        Given a 304 response, retrieves the cached entry. This unconditionally
-        returns the cached entry, so it can be used when the 'intelligent'
-        behaviour of retrieve() is not desired.
+        Returns False if a response is marked private but can't be kept in a
+        partition for its principal. That's the case in private mode when the
+        request carried no credentials, and whenever the cache may be shared
+        between principals and there's no partition to put it in.
+        """
+        cc = response.headers.get('Cache-Control', None)
+        if cc is None or 'private' not in parse_cache_control(cc):
+            return True
 
-        Returns None if there is no entry in the cache.
+        if not self.private_mode and not self._shared:
+            return True
 
-        :param response: The 304 response to find the cached entry for. Should be a Requests :class:`Response <Response>`.
+        return self._partition(response.request) is not None
+
+    def _expiry_from_headers(self, response, now, creation, rule):
+        """
+        Works out the expiry date of a response from its headers. Returns a
+        tuple of a boolean, False if the headers forbid caching, and the expiry
+        date, which may be None if the response must be revalidated.
+        """
+        # Get the value of the 'Cache-Control' header, if it exists. Only some
+        # directives tell us about freshness: if none of those are present, we
+        # fall back to the other headers.
+        cc = response.headers.get('Cache-Control', None)
+        directives = parse_cache_control(cc) if cc is not None else {}
+
+        if any(d in directives for d in FRESHNESS_DIRECTIVES):
+            expiry = expires_from_cache_control(cc, now)
+
+            # If the above returns None, we are explicitly instructed not to
+            # cache this.
+            return expiry is not None, expiry
+
+        # Get the value of the 'Expires' header, if it exists, and if we don't
+        # have anything from the 'Cache-Control' header.
+        if 'Expires' in response.headers:
+            return True, self._date_header(response, 'Expires', None)
+
+        # If there's no explicit freshness information at all, we may be able
+        # to work out how long the response is fresh for. Error responses are
+        # fresh for their configured TTL, others may be heuristically fresh.
+        ttl = self.negative_ttls.get(response.status_code)
+        if ttl is not None:
+            return True, now + timedelta(seconds=ttl)
+
+        return True, self._heuristic_expiry(response, creation, rule)
+
+    def _date_header(self, response, header_name, default):
+        """
+        Returns the value of a date header on a response, or the default if
+        the header is missing.
         """
         try:
-            cached_response = self._cache[response.url]['response']
+            date_header = response.headers[header_name]
         except KeyError:
-            cached_response = None
+            return default
 
-        return cached_response
+        return parse_date_header(date_header)
 
-    def retrieve(self, request):
+    def _match_rule(self, url):
         """
-        Retrieves a cached response if possible.
+        Returns the cache policy rule that applies to a URL, if any.
+        """
+        if self._policy is None:
+            return None
 
-        If there is a response that can be unconditionally returned (e.g. one
-        that had a Cache-Control header set), that response is returned. If
-        there is one that can be conditionally returned (if a 304 is returned),
-        applies an If-Modified-Since header to the request and returns None.
+        return self._policy.match(url)
 
-        :param request: The Requests :class:`PreparedRequest <PreparedRequest>` object.
+    def _bypasses(self, request):
+        """
+        Returns True if the cache policy says a request must not be answered
+        from the cache.
+        """
+        rule = self._match_rule(request.url)
+        return rule is not None and rule.bypass
+
+    def _clamp_expiry(self, expiry, rule, now):
+        """
+        Applies a rule's minimum and maximum lifetimes to an expiry date.
+        Responses that would otherwise need revalidating are fresh for the
+        minimum lifetime.
+        """
+        if rule.min_ttl is not None:
+            earliest = now + timedelta(seconds=rule.min_ttl)
+            if expiry is None or expiry < earliest:
+                expiry = earliest
+
+        if rule.max_ttl is not None and expiry is not None:
+            expiry = min(expiry, now + timedelta(seconds=rule.max_ttl))
+
+        return expiry
+
+    def _key(self, method, url, partition=None):
+        """
+        Builds the cache key for a request method and URL. Responses to GETs
+        are keyed by URL alone; other methods get their own keys. Keys in a
+        private partition are prefixed by the partition.
         """
-        return_response = None
-        url = request.url
+        key = url if method == 'GET' else '%s %s' % (method, url)
+
+        if partition is not None:
+            key = 'private:%s %s' % (partition, key)
+
+        return key
+
+    def _partition(self, request):
+        """
+        Returns the private partition for a request: a keyed hash of the
+        credentials it carries. Returns None if private mode is off or the
+        request carries no credentials.
+        """
+        if not self.private_mode or request is None:
+            return None
+
+        credentials = [request.headers.get(header, None)
+                       for header in CREDENTIAL_HEADERS]
+        if not any(credentials):
+            return None
+
+        principal = '\n'.join(value or '' for value in credentials)
+        digest = hmac.new(self._partition_secret, principal.encode('utf-8'),
+                          hashlib.sha256)
+        return digest.hexdigest()[:32]
+
+    def _lookup_keys(self, request):
+        """
+        Returns the keys of the cache entries that could answer a request, in
+        order of preference.
+        """
+        partition = self._partition(request)
+
+        if request.method == 'HEAD':
+            return [self._key('GET', request.url, partition),
+                    self._key('HEAD', request.url, partition)]
+
+        return [self._key(request.method, request.url, partition)]
+
+    def _url_keys(self, url):
+        """
+        Returns the keys of every cache entry for a URL, including entries for
+        the same path with a different query string and private entries.
+        """
+        keys = self._index.exact(url)
+        keys.update(self._key(method, url) for method in CACHEABLE_VERBS)
+        return keys
+
+    def _place_entry(self, response, entry):
+        """
+        Works out where a new cache entry should be stored, returning a tuple
+        of the key and the entry to store there.
+
+        A response to a HEAD is merged into a cached response to a GET for the
+        same URL, refreshing its headers and freshness but keeping its body.
+        If the status codes differ, or the validators show the GET's body has
+        changed, the GET response is thrown away instead.
+        """
+        method = response.request.method
+        partition = self._partition(response.request)
+        key = self._key(method, response.url, partition)
+
+        if partition is not None:
+            entry['partition'] = partition
+
+        if method != 'HEAD':
+            return key, entry
+
+        get_key = self._key('GET', response.url, partition)
 
         try:
-            cached_response = self._cache[url]
+            get_entry = self._cache[get_key]
         except KeyError:
+            return key, entry
+
+        cached = get_entry['response']
+
+        if response.status_code != cached.status_code:
+            self._remove(get_key)
+            return key, entry
+
+        for header in VALIDATOR_HEADERS:
+            new = response.headers.get(header, None)
+            old = cached.headers.get(header, None)
+
+            if new is not None and old is not None and new != old:
+                self._remove(get_key)
+                return key, entry
+
+        merged_response = copy.copy(cached)
+        merged_response.headers = CaseInsensitiveDict(cached.headers)
+        merged_response.headers.update(response.headers)
+
+        merged = dict(get_entry)
+        merged['response'] = merged_response
+        merged['creation'] = entry['creation']
+        merged['expiry'] = entry['expiry']
+
+        # The HEAD's own entry is now redundant.
+        self._remove(key)
+
+        return get_key, merged
+
+    def _track_partition(self, key, entry):
+        """
+        Records which private partition an entry belongs to, and enforces the
+        per-partition capacity by removing the partition's least recently used
+        entries.
+        """
+        partition = entry.get('partition')
+        if partition is None:
+            return
+
+        keys = self._partitions.setdefault(partition, RecentOrderedDict())
+        keys[key] = True
+        self._key_partitions[key] = partition
+
+        if self.partition_capacity is None:
+            return
+
+        while len(keys) > self.partition_capacity:
+            self._remove(next(iter(keys)))
+
+    def _touch(self, key):
+        """
+        Marks an entry as recently used, for the eviction policy and within its
+        private partition.
+        """
+        if self.eviction_policy is not None:
+            self.eviction_policy.access(key)
+
+        partition = self._key_partitions.get(key)
+        if partition is not None:
+            self._partitions[partition][key]
+
+    def _follow_redirects(self, request):
+        """
+        If the request is for a URL with a cached permanent redirect, points it
+        straight at the end of the chain of cached redirects, so that it can be
+        answered from the target's cache entry or sent directly to the target.
+        Credentials are not sent on to a different host.
+
+        Requests that ask for revalidation with 'no-cache', and redirects to
+        URLs the cache policy bypasses, are left alone.
+
+        :param request: The Requests :class:`PreparedRequest <PreparedRequest>` object.
+        """
+        if 'no-cache' in request_directives(request):
+            return
+
+        target = self._resolve_redirect(request.url)
+        if target == request.url:
+            return
+
+        rule = self._match_rule(target)
+        if rule is not None and rule.bypass:
+            return
+
+        if urlparse(target).hostname != urlparse(request.url).hostname:
+            for header in CREDENTIAL_HEADERS:
+                request.headers.pop(header, None)
+
+        request.url = target
+
+    def _resolve_redirect(self, url):
+        """
+        Follows the chain of fresh cached permanent redirects from a URL,
+        returning the final target. If the chain loops, the original URL is
+        returned, so the request is sent as normal. The chain stops short of
+        any redirect from https to http.
+        """
+        now = datetime.utcnow()
+        seen = set([url])
+        target = url
+
+        for _ in range(MAX_REDIRECT_HOPS):
+            try:
+                location, expiry = self._redirects[target]
+            except KeyError:
+                break
+
+            if expiry is not None and expiry < now:
+                break
+
+            if location in seen:
+                return url
+
+            if (urlparse(target).scheme == 'https' and
+                    urlparse(location).scheme != 'https'):
+                break
+
+            seen.add(location)
+            target = location
+
+        return target
+
+    def _heuristic_expiry(self, response, creation, rule=None):
+        """
+        Works out a heuristic expiry date for a response with no explicit
+        freshness information, as allowed by RFC 7234. The response is fresh
+        for a fraction of the time between its Last-Modified date and its
+        creation, up to a maximum. Returns None if no heuristic applies.
+        """
+        if not self.heuristic_fraction:
             return None
 
-        if request.method not in NON_INVALIDATING_VERBS:
-            del self._cache[url]
+        if rule is not None and rule.heuristic is False:
+            return None
+
+        host = (urlparse(response.url).hostname or '').lower()
+        if host in self.heuristic_disabled_hosts:
+            return None
+
+        last_modified = parse_date_header(response.headers.get('Last-Modified'))
+        if last_modified is None or last_modified >= creation:
             return None
 
-        if cached_response['expiry'] is None:
-            # We have no explicit expiry time, so we weren't instructed to
-            # cache. Add an 'If-Modified-Since' header.
-            creation = cached_response['creation']
-            header = build_date_header(creation)
-            request.headers['If-Modified-Since'] = header
+        age = timestamp(creation) - timestamp(last_modified)
+        lifetime = min(age * self.heuristic_fraction, self.heuristic_max_age)
+
+        if lifetime < 1:
+            return None
+
+        return creation + timedelta(seconds=lifetime)
+
+    def _evaluate(self, request, key, entry):
+        """
+        Decides how a cache entry may be used to answer a request, taking into
+        account the request's own Cache-Control directives. Returns a tuple of
+        the result (one of HIT, CONDITIONAL or EXPIRED, or None if the entry
+        can't be used) and the response to return, which is None unless the
+        result is HIT.
+
+        :param request: The Requests :class:`PreparedRequest <PreparedRequest>` object.
+        :param key: The key of the cache entry.
+        :param entry: The cache entry for the request's URL.
+        """
+        directives = request_directives(request)
+
+        # The client insists on going to the origin server.
+        if 'no-cache' in directives or 'no-store' in directives:
+            return None, None
+
+        # A cached GET may only answer a HEAD if it's fresh, and then only
+        # with its headers.
+        borrowed = (request.method == 'HEAD' and
+                    key == self._key('GET', request.url,
+                                     self._partition(request)))
+        now = datetime.utcnow()
+        expiry = entry['expiry']
+
+        if expiry is not None:
+            retention = timedelta(seconds=self.stale_retention)
+            if now > expiry + retention:
+                return EXPIRED, None
+
+            if self._acceptable(entry, directives, now):
+                response = entry['response']
+                if borrowed:
+                    response = bodyless_response(response)
+                return HIT, response
+
+        if borrowed:
+            return None, None
+
+        # The response can't be used as it is, so we need to check with the
+        # server. Add an 'If-Modified-Since' header.
+        creation = entry['creation']
+        header = build_date_header(creation)
+        request.headers['If-Modified-Since'] = header
+        return CONDITIONAL, None
+
+    def _acceptable(self, entry, directives, now):
+        """
+        Decides whether a cache entry with an expiry date is fresh enough to
+        answer a request, given the request's Cache-Control directives.
+        """
+        expiry = entry['expiry']
+
+        if 'max-age' in directives:
+            max_age = timedelta(seconds=directive_seconds(directives['max-age']))
+            if now - entry['creation'] > max_age:
+                return False
+
+        if 'min-fresh' in directives:
+            min_fresh = timedelta(seconds=directive_seconds(directives['min-fresh']))
+            if now + min_fresh > expiry:
+                return False
+
+        if now <= expiry:
+            return True
+
+        # The entry is stale, but the client may be happy with that.
+        if 'max-stale' in directives:
+            max_stale = directives['max-stale']
+            if max_stale is None:
+                return True
+
+            return now - expiry <= timedelta(seconds=directive_seconds(max_stale))
+
+        return False
+
+    def _get_many(self, keys):
+        """
+        Fetches many cache entries from the backend, in a single operation if
+        the backend supports it. Returns a dictionary of the entries found.
+        """
+        get_many = getattr(self._cache, 'get_many', None)
+        if get_many is not None:
+            return get_many(keys)
+
+        return dict((key, self._cache[key]) for key in keys
+                    if key in self._cache)
+
+    def _set_many(self, entries):
+        """
+        Writes many cache entries to the backend, in a single operation if the
+        backend supports it.
+        """
+        set_many = getattr(self._cache, 'set_many', None)
+        if set_many is not None:
+            set_many(entries)
         else:
-            # We have an explicit expiry time. If we're earlier than the expiry
-            # time, return the response.
-            now = datetime.utcnow()
+            for key, entry in entries.items():
+                self._cache[key] = entry
 
-            if now <= cached_response['expiry']:
-                return_response = cached_response['response']
-            else:
-                del self._cache[url]
+        for key, entry in entries.items():
+            self._index_entry(key, entry)
+
+    def _delete_many(self, keys):
+        """
+        Removes many cache entries from the backend, in a single operation if
+        the backend supports it. Keys that aren't present are ignored. Returns
+        the number of keys removed from the index.
+        """
+        keys = list(keys)
+        delete_many = getattr(self._cache, 'delete_many', None)
+        if delete_many is not None:
+            delete_many(keys)
+        else:
+            for key in keys:
+                if key in self._cache:
+                    del self._cache[key]
+
+        count = 0
+        for key in keys:
+            if key in self._index:
+                count += 1
+            self._forget(key)
+
+        return count
+
+    def _insert(self, key, entry):
+        """
+        Adds a single entry to the backend and the index.
+        """
+        self._cache[key] = entry
+        self._index_entry(key, entry)
 
-        return return_response
+    def _remove(self, key):
+        """
+        Removes a single entry from the backend and the index. Keys that aren't
+        present are ignored.
+        """
+        self._forget(key)
+        try:
+            del self._cache[key]
+        except KeyError:
+            pass
 
-    def __reduce_cache_count(self):
+    def _forget(self, key):
         """
-        Drops the number of entries in the cache to the capacity of the cache.
+        Removes a key from all of the structures that track cache entries
+        alongside the backend.
+        """
+        self._index.remove(key)
+        self._expiries.remove(key)
+        self._redirects.pop(key, None)
+
+        if self.eviction_policy is not None:
+            self.eviction_policy.remove(key)
+
+        memoized = self._memoized.pop(key, None)
+        if memoized is not None:
+            memoized.clear_memos()
+
+        digest = self._body_refs.pop(key, None)
+        if digest is not None:
+            self._bodies.release(digest)
+
+        partition = self._key_partitions.pop(key, None)
+        if partition is not None:
+            keys = self._partitions[partition]
+            del keys[key]
+            if not keys:
+                del self._partitions[partition]
+
+    def _index_entry(self, key, entry):
+        response = entry['response']
+        self._index.add(key, response.url, tags_from_headers(response.headers))
+
+        if self._bodies is not None:
+            self._share_body(key, response)
+
+        self._track_partition(key, entry)
+        self._track_memos(key, response)
+
+        if self.eviction_policy is not None:
+            body = getattr(response, '_content', None) or b''
+            self.eviction_policy.insert(key, len(body))
+
+        # Permanent redirects without an explicit expiry are fresh for as long
+        # as they stay in the cache.
+        location = response.headers.get('Location', None)
+        if response.status_code in PERMANENT_REDIRECT_RCS and location:
+            target = urljoin(response.url, location)
+            self._redirects[key] = (target, entry['expiry'])
+        else:
+            self._redirects.pop(key, None)
+
+        if entry['expiry'] is not None:
+            expires = timestamp(entry['expiry']) + self.stale_retention
+            self._expiries.add(key, expires)
+        else:
+            self._expiries.remove(key)
+
+    def _track_memos(self, key, response):
+        """
+        Records the memoizing response stored under a key, dropping the memos
+        of any response it replaces.
+        """
+        old = self._memoized.pop(key, None)
+        if old is not None and old is not response:
+            old.clear_memos()
+
+        if isinstance(response, MemoizedResponse):
+            self._memoized[key] = response
+
+    def _share_body(self, key, response):
+        """
+        Records a reference from a cache entry to its response body in the
+        deduplicating body store, and points the response at the store's copy
+        of the body so that identical bodies are held in memory only once.
+        """
+        old_digest = self._body_refs.pop(key, None)
+
+        body = getattr(response, 'content', None)
+        if body:
+            digest, shared = self._bodies.acquire(body)
+            self._body_refs[key] = digest
+
+            if getattr(response, '_content', None) is not None:
+                response._content = shared
+
+        # Release the old body last, in case it's the same as the new one.
+        if old_digest is not None:
+            self._bodies.release(old_digest)
 
-        Walks the backing RecentOrderedDict in order from oldest to youngest.
-        Deletes cache entries that are either invalid or being speculatively
-        cached until the number of cache entries drops to the capacity. If this
-        leaves the cache above capacity, begins deleting the least-used cache
-        entries that are still valid until the cache has space.
+    def _adjust_capacity(self):
         """
-        if len(self._cache) <= self.capacity:
+        Lets the memory controller, if there is one, adjust the capacity of the
+        cache, and then evicts entries until the cache is within its capacity.
+        With a memory controller, at most one batch of entries is evicted.
+        """
+        if self.memory_controller is None:
+            self.__reduce_cache_count()
             return
 
+        self.memory_controller.maybe_adjust(self)
+        evicted = self.__reduce_cache_count(self.memory_controller.batch_size)
+        self.memory_controller.metrics['evictions'] += evicted
+
+    def _sweep(self, limit):
+        """
+        Removes up to ``limit`` expired entries, or all of them if ``limit`` is
+        None. Returns the number of entries removed.
+        """
+        if limit == 0:
+            return 0
+
+        now = timestamp(datetime.utcnow())
+        expired = self._expiries.pop_expired(now, limit)
+
+        for key in expired:
+            self._remove(key)
+
+        return len(expired)
+
+    def _invalidate_url(self, url):
+        """
+        Removes every cache entry for a URL, including entries for the same
+        path with a different query string, as is required when an unsafe
+        method is used on it.
+        """
+        self._delete_many(self._url_keys(url))
+
+    def __reduce_cache_count(self, limit=None):
+        """
+        Drops the number of entries in the cache to the capacity of the cache,
+        removing at most ``limit`` entries if it is given. Returns the number
+        of entries removed.
+
+        Starts by removing entries that have expired. If there is an eviction
+        policy, it then chooses the entries to remove. Otherwise, walks the
+        backing RecentOrderedDict in order from oldest to youngest. Deletes
+        cache entries that are either invalid or being speculatively cached
+        until the number of cache entries drops to the capacity. If this leaves
+        the cache above capacity, begins deleting the least-used cache entries
+        that are still valid until the cache has space.
+        """
+        if self.capacity is None or len(self._cache) <= self.capacity:
+            return 0
+
         to_delete = len(self._cache) - self.capacity
+        if limit is not None:
+            to_delete = min(to_delete, limit)
+        total = to_delete
+
+        to_delete -= self._sweep(to_delete)
+
+        if to_delete == 0:
+            return total
+
+        # Entries the eviction policy doesn't know about, e.g. those already in
+        # the backend when the cache was created, fall through to the walk
+        # below.
+        if self.eviction_policy is not None:
+            to_delete = self.__evict(to_delete)
+
+            if to_delete == 0:
+                return total
+
         keys = list(self._cache.keys())
 
         for key in keys:
             if self._cache[key]['expiry'] is None:
-                del self._cache[key]
+                self._remove(key)
                 to_delete -= 1
 
             if to_delete == 0:
-                return
+                return total
 
         keys = list(self._cache.keys())
 
         for i in range(to_delete):
-            del self._cache[keys[i]]
+            self._remove(keys[i])
+
+        return total
+
+    def __evict(self, count):
+        """
+        Removes up to ``count`` entries chosen by the eviction policy. Returns
+        the number of entries the policy couldn't find to remove.
+        """
+        self.eviction_policy.capacity = self.capacity
+
+        while count > 0:
+            key = self.eviction_policy.evict()
+            if key is None:
+                break
+
+            self._remove(key)
+            count -= 1
 
-        return
+        return count
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+eviction.py
+~~~~~~~~~~~
+
+Defines the eviction policies that can be used by the HTTP cache to choose
+which entries to drop when it is full, and a simulator for comparing them on
+recorded traces without making any HTTP requests.
+"""
+import heapq
+import itertools
+from .structures import RecentOrderedDict
+
+
+class EvictionPolicy(object):
+    """
+    The interface for eviction policies. A policy tracks the keys resident in
+    the cache and, when asked, chooses which one to evict.
+
+    :param capacity: The number of entries the cache can hold, or None if it
+                     is unbounded.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+    def insert(self, key, size=0):
+        """
+        Records that a key has been added to the cache. Re-inserting a key
+        that is already resident counts as an access.
+        """
+        raise NotImplementedError
+
+    def access(self, key):
+        """
+        Records that a resident key has been used.
+        """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """
+        Records that a key has left the cache for a reason other than
+        eviction, e.g. invalidation. Unknown keys are ignored.
+        """
+        raise NotImplementedError
+
+    def evict(self):
+        """
+        Chooses a resident key to evict, stops tracking it and returns it.
+        Returns None if no keys are resident.
+        """
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used key.
+    """
+    def __init__(self, capacity):
+        super(LRUPolicy, self).__init__(capacity)
+        self._keys = RecentOrderedDict()
+
+    def insert(self, key, size=0):
+        self._keys.pop(key, None)
+        self._keys[key] = True
+
+    def access(self, key):
+        if key in self._keys:
+            self.insert(key)
+
+    def remove(self, key):
+        self._keys.pop(key, None)
+
+    def evict(self):
+        if not self._keys:
+            return None
+        return self._keys.popitem(last=False)[0]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+
+class SLRUPolicy(EvictionPolicy):
+    """
+    Segmented LRU. New keys enter a probationary segment and are promoted to a
+    protected segment when used again. Keys are evicted from the probationary
+    segment first, so keys used only once can't flush out popular ones.
+
+    :param capacity: The number of entries the cache can hold.
+    :param protected_fraction: (Optional) The share of the capacity reserved
+                               for the protected segment.
+    """
+    def __init__(self, capacity, protected_fraction=0.8):
+        super(SLRUPolicy, self).__init__(capacity)
+        self.protected_fraction = protected_fraction
+        self._probation = RecentOrderedDict()
+        self._protected = RecentOrderedDict()
+
+    def insert(self, key, size=0):
+        if key in self._probation or key in self._protected:
+            self.access(key)
+        else:
+            self._probation[key] = True
+
+    def access(self, key):
+        if key in self._protected:
+            del self._protected[key]
+            self._protected[key] = True
+        elif key in self._probation:
+            del self._probation[key]
+            self._protected[key] = True
+
+            # Demote the least recently used protected keys if there are too
+            # many of them. An unbounded cache has no limit.
+            if self.capacity is None:
+                return
+
+            limit = max(int(self.capacity * self.protected_fraction), 1)
+            while len(self._protected) > limit:
+                demoted = self._protected.popitem(last=False)[0]
+                self._probation[demoted] = True
+
+    def remove(self, key):
+        self._probation.pop(key, None)
+        self._protected.pop(key, None)
+
+    def evict(self):
+        for segment in (self._probation, self._protected):
+            if segment:
+                return segment.popitem(last=False)[0]
+        return None
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def __contains__(self, key):
+        return key in self._probation or key in self._protected
+
+
+class ARCPolicy(EvictionPolicy):
+    """
+    Adaptive Replacement Cache, as described by Megiddo and Modha. Balances
+    recency (keys seen once, T1) against frequency (keys seen more than once,
+    T2), using 'ghost' lists of recently evicted keys (B1 and B2) to learn
+    which matters more for the workload.
+    """
+    def __init__(self, capacity):
+        super(ARCPolicy, self).__init__(capacity)
+        self._t1 = RecentOrderedDict()
+        self._t2 = RecentOrderedDict()
+        self._b1 = RecentOrderedDict()
+        self._b2 = RecentOrderedDict()
+
+        # The target size of T1.
+        self._p = 0.0
+
+    def insert(self, key, size=0):
+        if key in self._t1 or key in self._t2:
+            self.access(key)
+            return
+
+        if key in self._b1:
+            # We evicted this recently-seen key too soon: favour recency.
+            delta = max(float(len(self._b2)) / len(self._b1), 1.0)
+            self._p = min(float(self._target()), self._p + delta)
+            del self._b1[key]
+            self._t2[key] = True
+        elif key in self._b2:
+            # We evicted this frequently-seen key too soon: favour frequency.
+            delta = max(float(len(self._b1)) / len(self._b2), 1.0)
+            self._p = max(0.0, self._p - delta)
+            del self._b2[key]
+            self._t2[key] = True
+        else:
+            self._t1[key] = True
+
+        self._trim_ghosts()
+
+    def access(self, key):
+        if key in self._t1:
+            del self._t1[key]
+            self._t2[key] = True
+        elif key in self._t2:
+            del self._t2[key]
+            self._t2[key] = True
+
+    def remove(self, key):
+        # Evicted keys stay in the ghost lists: they're still useful history.
+        self._t1.pop(key, None)
+        self._t2.pop(key, None)
+
+    def evict(self):
+        if self._t1 and (len(self._t1) > self._p or not self._t2):
+            key = self._t1.popitem(last=False)[0]
+            self._b1[key] = True
+        elif self._t2:
+            key = self._t2.popitem(last=False)[0]
+            self._b2[key] = True
+        else:
+            return None
+
+        self._trim_ghosts()
+        return key
+
+    def _target(self):
+        """
+        The size the lists are balanced against: the capacity or, for an
+        unbounded cache, the number of resident keys.
+        """
+        if self.capacity is None:
+            return max(len(self), 1)
+        return max(self.capacity, 1)
+
+    def _trim_ghosts(self):
+        capacity = self._target()
+
+        while self._b1 and len(self._t1) + len(self._b1) > capacity:
+            self._b1.popitem(last=False)
+
+        while self._b2 and len(self) + len(self._b1) + len(self._b2) > 2 * capacity:
+            self._b2.popitem(last=False)
+
+    def __len__(self):
+        return len(self._t1) + len(self._t2)
+
+    def __contains__(self, key):
+        return key in self._t1 or key in self._t2
+
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Least Frequently Used with dynamic aging (LFU-DA). Each key's priority is
+    its use count plus the cache 'age', which rises to the priority of each
+    evicted key. Keys that were popular long ago therefore lose out to keys
+    that are popular now, rather than staying in the cache forever.
+    """
+    def __init__(self, capacity):
+        super(LFUPolicy, self).__init__(capacity)
+        self._age = 0
+        self._counts = {}
+        self._priorities = {}
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def insert(self, key, size=0):
+        if key in self._counts:
+            self.access(key)
+            return
+
+        self._counts[key] = 1
+        self._push(key)
+
+    def access(self, key):
+        if key not in self._counts:
+            return
+
+        self._counts[key] += 1
+        self._push(key)
+
+    def remove(self, key):
+        self._counts.pop(key, None)
+        self._priorities.pop(key, None)
+
+    def evict(self):
+        while self._heap:
+            priority, sequence, key = heapq.heappop(self._heap)
+
+            # The heap may hold outdated records for a key: skip them.
+            if self._priorities.get(key) != (priority, sequence):
+                continue
+
+            self._age = priority
+            self.remove(key)
+            return key
+
+        return None
+
+    def _push(self, key):
+        record = (self._age + self._counts[key], next(self._sequence))
+        self._priorities[key] = record
+        heapq.heappush(self._heap, record + (key,))
+
+        # Rebuild the heap when outdated records start to dominate it.
+        if len(self._heap) > 2 * len(self._priorities) + 64:
+            self._heap = [record + (k,) for k, record in self._priorities.items()]
+            heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+
+#: The built-in eviction policies, by name.
+POLICIES = {'lru': LRUPolicy,
+            'slru': SLRUPolicy,
+            'arc': ARCPolicy,
+            'lfu': LFUPolicy}
+
+
+def make_policy(policy, capacity):
+    """
+    Given the name of a built-in eviction policy, a policy class or a policy
+    instance, returns a policy instance for a cache of the given capacity.
+    """
+    if isinstance(policy, EvictionPolicy):
+        policy.capacity = capacity
+        return policy
+
+    if not isinstance(policy, type):
+        try:
+            policy = POLICIES[policy]
+        except KeyError:
+            raise ValueError("Unknown eviction policy: %r" % (policy,))
+
+    return policy(capacity)
+
+
+def simulate(trace, policy, capacity):
+    """
+    Replays a trace of cache lookups through an eviction policy, without any
+    HTTP, and returns statistics describing how well the policy did.
+
+    Each record in the trace is a tuple of ``(key, size, ttl)``, or of
+    ``(timestamp, key, size, ttl)``. Without timestamps, the position of the
+    record in the trace is used as the time. ``ttl`` is the lifetime of the
+    response in the same units: a ttl of None never expires, and a ttl of
+    zero or less is never cached.
+
+    Returns a dictionary of counts (``requests``, ``hits``, ``misses``,
+    ``expired``, ``evictions``) and ratios (``hit_ratio`` and
+    ``byte_hit_ratio``).
+
+    :param trace: An iterable of trace records.
+    :param policy: The name of a built-in eviction policy, a policy class, or
+                   a fresh policy instance.
+    :param capacity: The number of entries the simulated cache can hold.
+    """
+    policy = make_policy(policy, capacity)
+    resident = {}
+    requests = hits = expired = evictions = 0
+    bytes_requested = bytes_hit = 0
+
+    for clock, record in enumerate(trace):
+        if len(record) == 4:
+            now, key, size, ttl = record
+        else:
+            key, size, ttl = record
+            now = clock
+
+        requests += 1
+        bytes_requested += size
+
+        if key in resident:
+            expires = resident[key]
+
+            if expires is None or now < expires:
+                hits += 1
+                bytes_hit += size
+                policy.access(key)
+                continue
+
+            expired += 1
+            del resident[key]
+            policy.remove(key)
+
+        if ttl is not None and ttl <= 0:
+            continue
+
+        resident[key] = now + ttl if ttl is not None else None
+        policy.insert(key, size)
+
+        while len(resident) > capacity:
+            victim = policy.evict()
+            if victim is None:
+                break
+
+            resident.pop(victim, None)
+            evictions += 1
+
+    return {'requests': requests,
+            'hits': hits,
+            'misses': requests - hits,
+            'expired': expired,
+            'evictions': evictions,
+            'hit_ratio': float(hits) / requests if requests else 0.0,
+            'byte_hit_ratio': (float(bytes_hit) / bytes_requested
+                               if bytes_requested else 0.0)}
+
+
+def compare(trace, capacity, policies=None):
+    """
+    Replays a trace through several eviction policies, returning a dictionary
+    mapping each policy name to the statistics returned by simulate(). The
+    trace must be a sequence, since it is replayed once per policy.
+
+    :param trace: A sequence of trace records, as for simulate().
+    :param capacity: The number of entries the simulated cache can hold.
+    :param policies: (Optional) The names of the policies to compare. Defaults
+                     to all of the built-in policies.
+    """
+    if policies is None:
+        policies = sorted(POLICIES)
+
+    return dict((name, simulate(trace, name, capacity)) for name in policies)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+memory.py
+~~~~~~~~~
+
+Contains a controller that adapts the capacity of the HTTP cache to the
+memory pressure on the process.
+"""
+import math
+import os
+import time
+
+# Locations of the memory usage and limit files for cgroup v2 and cgroup v1.
+CGROUP_V2_FILES = ('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory.max')
+CGROUP_V1_FILES = ('/sys/fs/cgroup/memory/memory.usage_in_bytes',
+                   '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+
+# cgroup v1 reports 'no limit' as a huge number rather than 'max'. Anything
+# above this is treated as unlimited.
+UNLIMITED_THRESHOLD = 1 << 60
+
+
+def _read_int(path):
+    """
+    Reads a single integer from a file, returning None if the file doesn't
+    exist or doesn't contain an integer.
+    """
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except (IOError, OSError):
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _process_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def sample_memory():
+    """
+    Returns a tuple of the current memory usage and the memory limit, in
+    bytes. Uses the cgroup's usage and limit if the process is in a cgroup
+    with a memory limit, and otherwise the process's resident set size and
+    the machine's physical memory. Returns ``(None, None)`` if neither can be
+    found.
+    """
+    for usage_path, limit_path in (CGROUP_V2_FILES, CGROUP_V1_FILES):
+        usage = _read_int(usage_path)
+        limit = _read_int(limit_path)
+
+        if usage is not None and limit is not None and limit < UNLIMITED_THRESHOLD:
+            return usage, limit
+
+    usage = _process_rss()
+    limit = _physical_memory()
+
+    if usage is None or limit is None:
+        return None, None
+
+    return usage, limit
+
+
+class MemoryController(object):
+    """
+    Adapts the capacity of an :class:`HTTPCache <httpcache.HTTPCache>` to
+    memory pressure. Every ``interval`` seconds the controller samples memory
+    usage. When usage rises above ``high_watermark`` (a fraction of the limit)
+    the capacity shrinks; when it falls below ``low_watermark`` the capacity
+    grows. The capacity always stays between ``min_capacity`` and
+    ``max_capacity``.
+
+    After a shrink, the cache evicts at most ``batch_size`` entries each time
+    it is used, until it is back within its capacity.
+
+    The controller's decisions are recorded in :attr:`metrics`.
+
+    :param min_capacity: The smallest capacity the cache may have.
+    :param max_capacity: The largest capacity the cache may have.
+    :param high_watermark: (Optional) The fraction of the memory limit above
+                           which the cache shrinks.
+    :param low_watermark: (Optional) The fraction of the memory limit below
+                          which the cache grows.
+    :param interval: (Optional) The minimum time, in seconds, between samples.
+    :param shrink_factor: (Optional) The factor the capacity is multiplied by
+                          when shrinking.
+    :param grow_factor: (Optional) The factor the capacity is multiplied by when
+                        growing.
+    :param batch_size: (Optional) The most entries evicted per cache operation.
+    :param sampler: (Optional) A callable returning a tuple of the memory usage
+                    and memory limit. Defaults to :func:`sample_memory`.
+    """
+    def __init__(self, min_capacity, max_capacity, high_watermark=0.85,
+                 low_watermark=0.6, interval=5.0, shrink_factor=0.75,
+                 grow_factor=1.1, batch_size=100, sampler=None):
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.interval = interval
+        self.shrink_factor = shrink_factor
+        self.grow_factor = grow_factor
+        self.batch_size = batch_size
+        self.sampler = sampler if sampler is not None else sample_memory
+
+        self._last_sample = None
+
+        #: Counters and gauges describing the controller's decisions.
+        self.metrics = {'samples': 0,
+                        'shrinks': 0,
+                        'grows': 0,
+                        'evictions': 0,
+                        'usage': None,
+                        'limit': None,
+                        'capacity': None}
+
+    def maybe_adjust(self, cache):
+        """
+        Samples memory usage, if at least ``interval`` seconds have passed since
+        the last sample, and adjusts the cache's capacity to match. Returns the
+        cache's capacity.
+
+        :param cache: The :class:`HTTPCache <httpcache.HTTPCache>` to adjust.
+        """
+        capacity = cache.capacity
+        if capacity is None:
+            capacity = self.max_capacity
+
+        now = time.time()
+        if self._last_sample is not None and now - self._last_sample < self.interval:
+            cache.capacity = capacity
+            return capacity
+
+        self._last_sample = now
+        usage, limit = self.sampler()
+
+        self.metrics['samples'] += 1
+        self.metrics['usage'] = usage
+        self.metrics['limit'] = limit
+
+        if usage is not None and limit:
+            pressure = float(usage) / limit
+
+            if pressure > self.high_watermark:
+                new = max(self.min_capacity, int(capacity * self.shrink_factor))
+                if new < capacity:
+                    self.metrics['shrinks'] += 1
+                capacity = new
+            elif pressure < self.low_watermark:
+                new = min(self.max_capacity,
+                          int(math.ceil(capacity * self.grow_factor)))
+                if new > capacity:
+                    self.metrics['grows'] += 1
+                capacity = new
+
+        capacity = min(max(capacity, self.min_capacity), self.max_capacity)
+        cache.capacity = capacity
+        self.metrics['capacity'] = capacity
+
+        return capacity
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+policy.py
+~~~~~~~~~
+
+Defines per-host and per-route overrides of the caching decisions httpcache
+makes from response headers.
+"""
+import fnmatch
+import re
+
+from .structures import RecentOrderedDict
+
+try:  # Python 2
+    from urlparse import urlparse
+except ImportError:  # Python 3
+    from urllib.parse import urlparse
+
+
+class CacheRule(object):
+    """
+    A single cache policy override, applied to every URL whose host and path
+    match the rule's patterns. Patterns are shell-style globs, e.g.
+    ``'*.internal'`` or ``'/api/*'``. Leave a pattern out to match anything.
+
+    :param host: (Optional) A pattern matched against the URL's hostname.
+    :param path: (Optional) A pattern matched against the URL's path.
+    :param ttl: (Optional) Cache matching responses for exactly this many
+                seconds, whatever their headers say.
+    :param min_ttl: (Optional) Cache matching responses for at least this many
+                    seconds.
+    :param max_ttl: (Optional) Cache matching responses for at most this many
+                    seconds.
+    :param bypass: (Optional) If True, never cache matching responses or
+                   answer matching requests from the cache.
+    :param max_size: (Optional) Don't cache matching responses with bodies
+                     larger than this many bytes.
+    :param heuristic: (Optional) If False, don't use heuristic freshness for
+                      matching responses.
+    """
+    def __init__(self, host=None, path=None, ttl=None, min_ttl=None,
+                 max_ttl=None, bypass=False, max_size=None, heuristic=None):
+        self.host = host.lower() if host is not None else None
+        self.path = path
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.bypass = bypass
+        self.max_size = max_size
+        self.heuristic = heuristic
+
+        self._path_re = re.compile(fnmatch.translate(path)) if path else None
+
+    def matches_path(self, path):
+        return self._path_re is None or self._path_re.match(path) is not None
+
+
+class CachePolicy(object):
+    """
+    A table of :class:`CacheRule <CacheRule>` objects, compiled for fast
+    matching. Rules are tried in order, and the first match wins.
+
+    Rules with a literal hostname are found with a single dictionary lookup.
+    The candidate rules for recently seen hostnames are worked out once and
+    remembered, so the cost of matching a URL depends only on the number of
+    rules that could apply to its host.
+
+    :param rules: An iterable of :class:`CacheRule <CacheRule>` objects.
+    :param max_hosts: (Optional) The number of hostnames to remember the
+                      candidate rules for.
+    """
+    def __init__(self, rules, max_hosts=1024):
+        self.rules = list(rules)
+
+        self._exact = {}
+        self._wildcard = []
+
+        for position, rule in enumerate(self.rules):
+            if rule.host is None:
+                self._wildcard.append((position, rule, None))
+            elif any(c in rule.host for c in '*?['):
+                host_re = re.compile(fnmatch.translate(rule.host))
+                self._wildcard.append((position, rule, host_re))
+            else:
+                self._exact.setdefault(rule.host, []).append((position, rule))
+
+        # Maps recently seen hostnames to their candidate rules, in order.
+        self.max_hosts = max_hosts
+        self._candidates = RecentOrderedDict()
+
+    def match(self, url):
+        """
+        Returns the first rule matching the URL, or None if no rule matches.
+        """
+        parsed = urlparse(url)
+        host = (parsed.hostname or '').lower()
+
+        try:
+            candidates = self._candidates[host]
+        except KeyError:
+            candidates = self._build_candidates(host)
+
+        path = parsed.path or '/'
+        for rule in candidates:
+            if rule.matches_path(path):
+                return rule
+
+        return None
+
+    def _build_candidates(self, host):
+        matched = list(self._exact.get(host, []))
+        matched.extend((position, rule) for position, rule, host_re
+                       in self._wildcard
+                       if host_re is None or host_re.match(host))
+        matched.sort(key=lambda item: item[0])
+
+        candidates = [rule for _, rule in matched]
+        self._candidates[host] = candidates
+
+        while len(self._candidates) > self.max_hosts:
+            self._candidates.popitem(last=False)
+
+        return candidates
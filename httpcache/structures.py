@@ -4,56 +4,423 @@ structures.py
 
 Defines structures used by the httpcache module.
 """
+import hashlib
+import heapq
+import math
+
+try:  # Python 2
+    from urlparse import urlparse
+except ImportError:  # Python 3
+    from urllib.parse import urlparse
+
 
 class RecentOrderedDict(dict):
     """
     A custom variant of the dictionary that ensures that the object most
-    recently inserted _or_ retrieved from the dictionary is enumerated first.
+    recently inserted _or_ retrieved from the dictionary is enumerated last.
+
+    The order is kept in a doubly-linked list, so that inserting, retrieving
+    and deleting a key all take constant time.
     """
+    # The fields of each link in the list.
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
     def __init__(self):
-        self._data = {}
-        self._order = []
+        self.clear()
 
     def __setitem__(self, key, value):
-        if key in self._data:
-            self._order.remove(key)
+        link = self._data.get(key)
+
+        if link is not None:
+            self._unlink(link)
+            link[self.VALUE] = value
+        else:
+            link = [None, None, key, value]
+            self._data[key] = link
 
-        self._order.append(key)
-        self._data[key] = value
+        self._append(link)
 
     def __getitem__(self, key):
-        value = self._data[key]
-        self._order.remove(key)
-        self._order.append(key)
-        return value
+        link = self._data[key]
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
 
     def __delitem__(self, key):
-        del self._data[key]
-        self._order.remove(key)
+        self._unlink(self._data.pop(key))
 
     def __iter__(self):
-        return self._order
+        root = self._root
+        link = root[self.NEXT]
+
+        while link is not root:
+            # Fetch the next link first, in case this key is deleted.
+            following = link[self.NEXT]
+            yield link[self.KEY]
+            link = following
 
     def __len__(self):
-        return len(self._order)
+        return len(self._data)
 
     def __contains__(self, value):
         return self._data.__contains__(value)
 
     def items(self):
-        return [(key, self._data[key]) for key in self._order]
+        return [(key, self._data[key][self.VALUE]) for key in self]
 
     def keys(self):
-        return self._order
+        return list(self)
 
     def values(self):
-        return [self._data[key] for key in self._order]
+        return [self._data[key][self.VALUE] for key in self]
+
+    def pop(self, key, *default):
+        """
+        Removes a key and returns its value, or the default if the key isn't
+        present and one is given.
+        """
+        try:
+            link = self._data.pop(key)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+        self._unlink(link)
+        return link[self.VALUE]
+
+    def popitem(self, last=True):
+        """
+        Removes and returns the most recently used (key, value) pair, or the
+        least recently used one if ``last`` is False.
+        """
+        if not self._data:
+            raise KeyError('dictionary is empty')
+
+        link = self._root[self.PREV if last else self.NEXT]
+        del self[link[self.KEY]]
+        return link[self.KEY], link[self.VALUE]
 
     def clear(self):
         self._data = {}
-        self._order = []
+        self._root = root = []
+        root[:] = [root, root, None, None]
 
     def copy(self):
         c = RecentOrderedDict()
-        c._data = self._data.copy()
-        c._order = self._order[:]
+        for key, value in self.items():
+            c[key] = value
+        return c
+
+    def _append(self, link):
+        root = self._root
+        last = root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = root
+        last[self.NEXT] = link
+        root[self.PREV] = link
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+
+class _IndexNode(object):
+    """
+    A single node in an InvalidationIndex trie.
+    """
+    __slots__ = ('children', 'keys')
+
+    def __init__(self):
+        self.children = {}
+        self.keys = set()
+
+
+class InvalidationIndex(object):
+    """
+    An index of cache keys that allows groups of related cache entries to be
+    found without walking the whole cache. Keys are indexed in a trie, ordered
+    by host, then origin (scheme and port), then path segment, and by any tags
+    given when the key is added.
+
+    All lookups cost time proportional to the number of keys they return.
+    """
+    def __init__(self):
+        self._root = _IndexNode()
+        self._tags = {}
+
+        # Maps each key to the trie path and the tags it was added with.
+        self._locations = {}
+
+    def add(self, key, url, tags=()):
+        """
+        Adds a key to the index, replacing any existing record of it.
+        """
+        self.remove(key)
+
+        path = self._path(url)
+        node = self._root
+        for part in path:
+            node = node.children.setdefault(part, _IndexNode())
+        node.keys.add(key)
+
+        tags = frozenset(tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        self._locations[key] = (path, tags)
+
+    def remove(self, key):
+        """
+        Removes a key from the index. Unknown keys are ignored.
+        """
+        try:
+            path, tags = self._locations.pop(key)
+        except KeyError:
+            return
+
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+        nodes = [self._root]
+        for part in path:
+            nodes.append(nodes[-1].children[part])
+        nodes[-1].keys.discard(key)
+
+        # Prune any nodes that no longer lead to a key.
+        for i in range(len(path), 0, -1):
+            node = nodes[i]
+            if node.keys or node.children:
+                break
+            del nodes[i - 1].children[path[i - 1]]
+
+    def exact(self, url):
+        """
+        Returns the keys added for exactly this URL's path, ignoring any query
+        string.
+        """
+        node = self._find(self._path(url))
+        return set(node.keys) if node is not None else set()
+
+    def prefix(self, url):
+        """
+        Returns the keys added for this URL's path or any path below it. Paths
+        are matched a whole segment at a time, so ``/api/user`` does not match
+        ``/api/users``.
+        """
+        return self._collect(self._find(self._path(url)))
+
+    def host(self, host):
+        """
+        Returns the keys added for any URL on the given host, regardless of
+        scheme or port.
+        """
+        return self._collect(self._root.children.get(host.lower()))
+
+    def tag(self, tag):
+        """
+        Returns the keys added with the given tag.
+        """
+        return set(self._tags.get(tag, ()))
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, key):
+        return key in self._locations
+
+    def _path(self, url):
+        parsed = urlparse(url)
+        host = (parsed.hostname or '').lower()
+        origin = '%s:%s' % (parsed.scheme.lower(), parsed.port or '')
+        segments = [segment for segment in parsed.path.split('/') if segment]
+        return tuple([host, origin] + segments)
+
+    def _find(self, path):
+        node = self._root
+        for part in path:
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _collect(self, node):
+        keys = set()
+        if node is None:
+            return keys
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            keys.update(node.keys)
+            stack.extend(node.children.values())
+
+        return keys
+
+
+class ExpiryBuckets(object):
+    """
+    Groups keys into buckets by expiry time, so that expired keys can be found
+    without walking every key. Each bucket covers ``granularity`` seconds, and
+    a heap keeps the buckets in order of expiry.
+
+    Expiry times are given as seconds since the epoch.
+    """
+    def __init__(self, granularity=1.0):
+        self.granularity = granularity
+        self._buckets = {}
+        self._heap = []
+        self._key_buckets = {}
+
+    def add(self, key, expiry):
+        """
+        Records the expiry time of a key, replacing any earlier record.
+        """
+        self.remove(key)
+
+        # A bucket is only due once the latest expiry time it covers passes.
+        bucket = int(math.ceil(expiry / self.granularity))
+
+        if bucket not in self._buckets:
+            self._buckets[bucket] = set()
+            heapq.heappush(self._heap, bucket)
+
+        self._buckets[bucket].add(key)
+        self._key_buckets[key] = bucket
+
+    def remove(self, key):
+        """
+        Forgets the expiry time of a key. Unknown keys are ignored.
+        """
+        bucket = self._key_buckets.pop(key, None)
+        if bucket is None:
+            return
+
+        self._buckets[bucket].discard(key)
+
+        # Empty buckets stay on the heap, and in the bucket map so that adding
+        # to them again doesn't push a duplicate, until they come due. If they
+        # start to outnumber the keys, throw them away.
+        if len(self._heap) > 2 * len(self._key_buckets) + 64:
+            self._compact()
+
+    def _compact(self):
+        """
+        Drops empty buckets and rebuilds the heap from the remaining ones.
+        """
+        self._buckets = dict((bucket, keys) for bucket, keys
+                             in self._buckets.items() if keys)
+        self._heap = list(self._buckets)
+        heapq.heapify(self._heap)
+
+    def pop_expired(self, now, limit=None):
+        """
+        Removes and returns up to ``limit`` keys whose buckets expired at or
+        before ``now``, oldest first. If ``limit`` is None, returns them all.
+        """
+        expired = []
+
+        while self._heap and (limit is None or len(expired) < limit):
+            bucket = self._heap[0]
+            if bucket * self.granularity > now:
+                break
+
+            keys = self._buckets.get(bucket)
+            while keys and (limit is None or len(expired) < limit):
+                key = keys.pop()
+                del self._key_buckets[key]
+                expired.append(key)
+
+            if not keys:
+                heapq.heappop(self._heap)
+                self._buckets.pop(bucket, None)
+
+        return expired
+
+    def __len__(self):
+        return len(self._key_buckets)
+
+
+class BodyStore(object):
+    """
+    A reference-counted store of response bodies, keyed by a hash of their
+    content. Identical bodies acquired by several cache entries are held only
+    once, and a body is dropped when the last entry referencing it releases it.
+    """
+    def __init__(self):
+        # Maps each digest to a list of the body and its reference count.
+        self._bodies = {}
+
+        #: The total size of all the references held, in bytes.
+        self.logical_bytes = 0
+
+        #: The total size of the distinct bodies held, in bytes.
+        self.stored_bytes = 0
+
+    def acquire(self, body):
+        """
+        Takes a reference to a body. Returns a tuple of the body's digest, used
+        to release it later, and the store's shared copy of the body.
+        """
+        digest = hashlib.sha1(body).digest()
+        record = self._bodies.get(digest)
+
+        if record is None:
+            record = [body, 0]
+            self._bodies[digest] = record
+            self.stored_bytes += len(body)
+
+        record[1] += 1
+        self.logical_bytes += len(record[0])
+
+        return digest, record[0]
+
+    def release(self, digest):
+        """
+        Drops a reference to a body, freeing the body if it was the last one.
+        """
+        record = self._bodies[digest]
+        record[1] -= 1
+        self.logical_bytes -= len(record[0])
+
+        if record[1] == 0:
+            del self._bodies[digest]
+            self.stored_bytes -= len(record[0])
+
+    def __len__(self):
+        return len(self._bodies)
+
+
+class FrozenDict(dict):
+    """
+    A dictionary that can't be changed once it has been built. Used to hand
+    out shared parsed JSON bodies without letting one caller alter what the
+    next one sees.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict objects are read-only.")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """
+    A list that can't be changed once it has been built. It is still a list,
+    so code that checks for one keeps working.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenList objects are read-only.")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    __setslice__ = __delslice__ = _readonly
+    append = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
@@ -5,8 +5,16 @@ utils.py
 
 Utility functions for use with httpcache.
 """
+import marshal
+import sys
+import zlib
 from datetime import datetime, timedelta
 
+from requests.models import Response, PreparedRequest
+from requests.structures import CaseInsensitiveDict
+
+from .structures import FrozenDict, FrozenList
+
 try:  # Python 2
     from urlparse import urlparse
 except ImportError:  # Python 3
@@ -14,6 +22,7 @@ except ImportError:  # Python 3
 
 RFC_1123_DT_STR = "%a, %d %b %Y %H:%M:%S GMT"
 RFC_850_DT_STR = "%A, %d-%b-%y %H:%M:%S GMT"
+EPOCH = datetime(1970, 1, 1)
 
 
 def parse_date_header(header):
@@ -54,6 +63,57 @@ def build_date_header(dt):
     return dt.strftime(RFC_1123_DT_STR)
 
 
+def timestamp(dt):
+    """
+    Given a naive Python datetime object in UTC, return the number of seconds
+    since the epoch as a float.
+    """
+    delta = dt - EPOCH
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def parse_cache_control(header):
+    """
+    Given a Cache-Control header, returns a dictionary mapping each directive
+    (lower-cased) to its value. Directives without a value map to None, and
+    quoted values are unquoted.
+    """
+    directives = {}
+
+    for field in header.split(','):
+        name, _, value = field.partition('=')
+        name = name.strip().lower()
+
+        if not name:
+            continue
+
+        value = value.strip().strip('"') if value else None
+        directives[name] = value
+
+    return directives
+
+
+def request_directives(request):
+    """
+    Returns the Cache-Control directives sent on a request, as a dictionary
+    built by parse_cache_control().
+    """
+    header = request.headers.get('Cache-Control', None)
+    return parse_cache_control(header) if header else {}
+
+
+def directive_seconds(value):
+    """
+    Given the value of a Cache-Control directive that holds a number of
+    seconds, return it as an integer. Missing or invalid values are treated as
+    zero.
+    """
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
 def expires_from_cache_control(header, current_time):
     """
     Given a Cache-Control header, builds a Python datetime object corresponding
@@ -61,28 +121,21 @@ def expires_from_cache_control(header, current_time):
     Cache-Control directives.
 
     Takes current_time as an argument to ensure that 'max-age=0' generates the
-    correct behaviour without being special-cased.
+    correct behaviour without being special-cased. A missing or invalid
+    max-age is treated as 'max-age=0'.
 
     Returns None to indicate that a request must not be cached.
     """
-    # Cache control header values are made of multiple comma separated fields.
-    # Splitting them like this is probably a bad idea, but I'm going to roll with
-    # it for now. We'll come back to it.
-    fields = header.split(', ')
-    duration = None
-
-    for field in fields:
-        # Right now we don't handle no-cache applied to specific fields. To be
-        # as 'nice' as possible, treat any no-cache as applying to the whole
-        # request. Bail early, because there's no reason to stick around.
-        if field.startswith('no-cache') or field == 'no-store':
-            return None
+    directives = parse_cache_control(header)
 
-        if field.startswith('max-age'):
-            _, duration = field.split('=')
-            duration = int(duration)
+    # Right now we don't handle no-cache applied to specific fields. To be
+    # as 'nice' as possible, treat any no-cache as applying to the whole
+    # request.
+    if 'no-cache' in directives or 'no-store' in directives:
+        return None
 
-    interval = timedelta(seconds=int(duration))
+    duration = directive_seconds(directives.get('max-age'))
+    interval = timedelta(seconds=duration)
 
     return current_time + interval
 
@@ -96,3 +149,250 @@ def url_contains_query(url):
         return True
     else:
         return False
+
+
+def tags_from_headers(headers):
+    """
+    Given the headers of a response, returns the set of cache tags (also
+    known as surrogate keys) the response was labelled with. Understands the
+    space-separated ``Surrogate-Key`` header and the comma-separated
+    ``Cache-Tag`` header.
+    """
+    tags = set()
+
+    surrogate = headers.get('Surrogate-Key', None)
+    if surrogate:
+        tags.update(surrogate.split())
+
+    cache_tag = headers.get('Cache-Tag', None)
+    if cache_tag:
+        tags.update(tag.strip() for tag in cache_tag.split(',') if tag.strip())
+
+    return tags
+
+
+def bodyless_response(response):
+    """
+    Given a Requests Response, builds a copy of it that has the same status
+    line and headers but no body.
+    """
+    stripped = Response()
+    stripped.status_code = response.status_code
+    stripped.reason = getattr(response, 'reason', None)
+    stripped.url = response.url
+    stripped.encoding = getattr(response, 'encoding', None)
+    stripped.headers = CaseInsensitiveDict(response.headers)
+    stripped.request = response.request
+    stripped._content = b''
+    stripped._content_consumed = True
+
+    return stripped
+
+
+def gateway_timeout_response(request):
+    """
+    Builds a 504 Gateway Timeout response for a request, as returned to
+    clients that ask for a cached response with 'only-if-cached' when none is
+    available.
+    """
+    response = Response()
+    response.status_code = 504
+    response.reason = 'Gateway Timeout'
+    response.url = request.url
+    response.request = request
+    response._content = b''
+    response._content_consumed = True
+
+    return response
+
+
+def compact_response(response):
+    """
+    Given a Requests Response, builds a compact, picklable tuple containing
+    only the parts of the response needed to rebuild it. The body is
+    compressed if doing so makes it smaller.
+    """
+    body = getattr(response, 'content', None) or b''
+    compressed = zlib.compress(body, 1)
+
+    if len(compressed) < len(body):
+        body, is_compressed = compressed, True
+    else:
+        is_compressed = False
+
+    request = response.request
+
+    return (response.status_code,
+            getattr(response, 'reason', None),
+            response.url,
+            getattr(response, 'encoding', None),
+            list(response.headers.items()),
+            request.method if request is not None else None,
+            is_compressed,
+            body)
+
+
+def expand_response(data):
+    """
+    Given a tuple built by compact_response(), rebuilds the Requests Response
+    it was made from.
+    """
+    status, reason, url, encoding, headers, method, is_compressed, body = data
+
+    response = Response()
+    response.status_code = status
+    response.reason = reason
+    response.url = url
+    response.encoding = encoding
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = zlib.decompress(body) if is_compressed else body
+    response._content_consumed = True
+
+    if method is not None:
+        request = PreparedRequest()
+        request.method = method
+        request.url = url
+        request.headers = CaseInsensitiveDict()
+        response.request = request
+
+    return response
+
+
+def freeze(value):
+    """
+    Given a parsed JSON value, builds a read-only copy of it, turning
+    dictionaries into FrozenDicts and lists into FrozenLists.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+
+    return value
+
+
+def approximate_size(value):
+    """
+    Estimates the memory, in bytes, used by a parsed JSON value and everything
+    it contains.
+    """
+    total = 0
+    pending = [value]
+
+    while pending:
+        item = pending.pop()
+        total += sys.getsizeof(item)
+
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+
+    return total
+
+
+class MemoizedResponse(Response):
+    """
+    A Requests Response that remembers its decoded text and parsed JSON body
+    the first time they are used, so that a response served many times from
+    the cache is only decoded once.
+
+    In ``'readonly'`` mode the parsed JSON is shared between callers and
+    frozen, so they can't change it: dictionaries are FrozenDicts and lists
+    are FrozenLists, which raise TypeError if modified. In ``'copy'`` mode a
+    marshalled snapshot of the parsed JSON is kept, and each call to json()
+    loads a fresh copy from it, which is cheaper than parsing the JSON again
+    or deep-copying it.
+
+    Memos are not pickled, and are dropped by clear_memos().
+    """
+    __attrs__ = Response.__attrs__ + ['memo_mode', 'memo_budget']
+
+    #: How parsed JSON is handed out: ``'readonly'`` or ``'copy'``.
+    memo_mode = 'readonly'
+
+    #: The most bytes the memos may use, or None for no limit. Values too
+    #: large for the budget are still returned, but not remembered.
+    memo_budget = None
+
+    @classmethod
+    def from_response(cls, response, mode='readonly', budget=None):
+        """
+        Builds a MemoizedResponse from a Requests Response, reading its body.
+        """
+        response.content
+
+        memoized = cls()
+        memoized.__setstate__(dict((name, getattr(response, name, None))
+                                   for name in Response.__attrs__))
+        memoized.memo_mode = mode
+        memoized.memo_budget = budget
+        return memoized
+
+    @property
+    def text(self):
+        memos = self._memos()
+
+        try:
+            return memos['text']
+        except KeyError:
+            text = Response.text.fget(self)
+            self._remember('text', text, sys.getsizeof(text))
+            return text
+
+    def json(self, **kwargs):
+        # Custom decoding options can't share the memo.
+        if kwargs:
+            return super(MemoizedResponse, self).json(**kwargs)
+
+        memos = self._memos()
+
+        try:
+            value = memos['json']
+        except KeyError:
+            value = super(MemoizedResponse, self).json()
+
+            if self.memo_mode == 'copy':
+                snapshot = marshal.dumps(value)
+                self._remember('json', snapshot, len(snapshot))
+                return value
+
+            value = freeze(value)
+            self._remember('json', value, approximate_size(value))
+            return value
+
+        if self.memo_mode == 'copy':
+            return marshal.loads(value)
+
+        return value
+
+    @property
+    def memo_size(self):
+        """
+        The approximate number of bytes used by the memos.
+        """
+        return getattr(self, '_memo_size', 0)
+
+    def clear_memos(self):
+        """
+        Forgets the decoded text and parsed JSON.
+        """
+        self._memo = {}
+        self._memo_size = 0
+
+    def _memos(self):
+        memos = getattr(self, '_memo', None)
+        if memos is None:
+            self.clear_memos()
+            memos = self._memo
+        return memos
+
+    def _remember(self, name, value, size):
+        if self.memo_budget is not None:
+            if self.memo_size + size > self.memo_budget:
+                return
+
+        self._memos()[name] = value
+        self._memo_size = self.memo_size + size
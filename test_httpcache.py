@@ -7,7 +7,13 @@ Test cases for httpcache.
 """
 import httpcache
 from datetime import datetime, timedelta
+import gc
+import io
+import pickle
+import pytest
 import requests
+import threading
+import weakref
 
 
 class TestHTTPCache(object):
@@ -238,6 +244,1453 @@ class TestHTTPCache(object):
         assert test_resp not in [cache._cache[key] for key in list(cache._cache.keys())]
 
 
+class TestUtils(object):
+    """
+    Tests for the utility functions used by httpcache.
+    """
+    def test_parse_cache_control(self):
+        directives = httpcache.utils.parse_cache_control('Public,max-age="60" ,  no-transform')
+
+        assert directives == {'public': None, 'max-age': '60', 'no-transform': None}
+
+    def test_cache_control_without_max_age_is_stale(self):
+        now = datetime.utcnow()
+
+        assert httpcache.utils.expires_from_cache_control('public', now) == now
+        assert httpcache.utils.expires_from_cache_control('no-cache', now) is None
+
+
+class TestBatchOperations(object):
+    """
+    Tests for the batch retrieve and store methods of the HTTPCache object.
+    """
+    def test_store_many_reports_what_was_cached(self):
+        cache = httpcache.HTTPCache()
+        resp1 = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        resp2 = MockRequestsResponse(status_code=403)
+        resp2.url += 'forbidden'
+
+        assert cache.store_many([resp1, resp2]) == [True, False]
+        assert len(cache._cache) == 1
+
+    def test_retrieve_many_splits_results(self):
+        cache = httpcache.HTTPCache()
+        fresh = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        conditional = MockRequestsResponse(url='http://www.test.com/cond')
+        cache.store_many([fresh, conditional])
+
+        requests = [MockRequestsPreparedRequest(headers={}),
+                    MockRequestsPreparedRequest(headers={},
+                                                url='http://www.test.com/cond'),
+                    MockRequestsPreparedRequest(headers={},
+                                                url='http://www.test.com/miss')]
+        hits, misses, conditionals = cache.retrieve_many(requests)
+
+        assert hits == [(requests[0], fresh)]
+        assert misses == [requests[2]]
+        assert conditionals == [requests[1]]
+        assert 'If-Modified-Since' in requests[1].headers
+
+    def test_retrieve_many_drops_expired_entries(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={})
+        cache._cache[req.url] = {'response': None,
+                                 'creation': datetime.utcnow() - timedelta(days=1),
+                                 'expiry': datetime.utcnow() - timedelta(seconds=60)}
+
+        hits, misses, conditionals = cache.retrieve_many([req])
+
+        assert misses == [req]
+        assert len(cache._cache) == 0
+
+    def test_batches_use_one_backend_round_trip(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server, near_cache_size=0)
+        cache = httpcache.HTTPCache(capacity=None, backend=backend)
+        responses = []
+        for i in range(5):
+            resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+            resp.url += str(i)
+            responses.append(resp)
+
+        calls = server.calls
+        cache.store_many(responses)
+        assert server.calls == calls + 1
+
+        requests = [MockRequestsPreparedRequest(url=r.url) for r in responses]
+        calls = server.calls
+        hits, misses, conditionals = cache.retrieve_many(requests)
+
+        assert server.calls == calls + 1
+        assert len(hits) == 5
+
+
+class TestSnapshots(object):
+    """
+    Tests for dumping the contents of the HTTPCache object to a snapshot and
+    loading them back.
+    """
+    def test_snapshot_round_trip(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        resp.content = b'hello world' * 100
+        cache.store(resp)
+
+        snapshot = io.BytesIO()
+        assert cache.dump(snapshot) == 1
+
+        snapshot.seek(0)
+        new_cache = httpcache.HTTPCache()
+        assert new_cache.load(snapshot) == 1
+
+        req = MockRequestsPreparedRequest()
+        cached_resp = new_cache.retrieve(req)
+        assert cached_resp.content == resp.content
+        assert cached_resp.status_code == 200
+        assert cached_resp.headers['cache-control'] == 'max-age=3600'
+        assert new_cache._cache[req.url]['expiry'] == cache._cache[req.url]['expiry']
+
+    def test_load_skips_entries_that_expired(self):
+        resp = MockRequestsResponse()
+        meta = {'creation': datetime.utcnow() - timedelta(days=1),
+                'expiry': datetime.utcnow() - timedelta(seconds=1)}
+        record = (resp.url, meta, httpcache.utils.compact_response(resp))
+
+        snapshot = io.BytesIO()
+        snapshot.write(httpcache.cache.SNAPSHOT_MAGIC)
+        pickle.dump(record, snapshot)
+        snapshot.seek(0)
+
+        cache = httpcache.HTTPCache()
+        assert cache.load(snapshot) == 0
+        assert len(cache._cache) == 0
+
+    def test_load_preserves_recency_order(self):
+        cache = httpcache.HTTPCache()
+        for i in range(3):
+            resp = MockRequestsResponse()
+            resp.url += str(i)
+            cache.store(resp)
+
+        snapshot = io.BytesIO()
+        cache.dump(snapshot)
+        snapshot.seek(0)
+
+        new_cache = httpcache.HTTPCache(capacity=2)
+        assert new_cache.load(snapshot) == 3
+        assert list(new_cache._cache.keys()) == ['http://www.test.com/1',
+                                                 'http://www.test.com/2']
+
+    def test_load_rejects_other_files(self):
+        cache = httpcache.HTTPCache()
+
+        try:
+            cache.load(io.BytesIO(b'not a snapshot'))
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected a ValueError."
+
+
+class TestInvalidation(object):
+    """
+    Tests for bulk invalidation of entries in the HTTPCache object.
+    """
+    def build_cache(self, urls, headers={}):
+        cache = httpcache.HTTPCache(capacity=100)
+        headers = dict(headers)
+        headers['Cache-Control'] = 'max-age=3600'
+
+        for url in urls:
+            assert cache.store(MockRequestsResponse(url=url, headers=headers))
+        return cache
+
+    def test_unsafe_methods_invalidate_query_variants(self):
+        cache = self.build_cache(['http://www.test.com/api/users/7',
+                                  'http://www.test.com/api/users/7?fields=x',
+                                  'http://www.test.com/api/users'])
+        req = MockRequestsPreparedRequest(method='POST',
+                                          url='http://www.test.com/api/users/7')
+
+        assert cache.retrieve(req) is None
+        assert list(cache._cache.keys()) == ['http://www.test.com/api/users']
+
+    def test_unsafe_methods_invalidate_uncached_urls_variants(self):
+        cache = self.build_cache(['http://www.test.com/a?b=c'])
+        req = MockRequestsPreparedRequest(method='DELETE',
+                                          url='http://www.test.com/a')
+
+        cache.retrieve(req)
+        assert len(cache._cache) == 0
+
+    def test_invalidate_prefix(self):
+        cache = self.build_cache(['http://www.test.com/api/users',
+                                  'http://www.test.com/api/users/7?a=b',
+                                  'http://www.test.com/api/users/7/posts',
+                                  'http://www.test.com/api/usersettings',
+                                  'https://www.test.com/api/users/8'])
+
+        assert cache.invalidate_prefix('http://www.test.com/api/users') == 3
+        assert sorted(cache._cache.keys()) == ['http://www.test.com/api/usersettings',
+                                               'https://www.test.com/api/users/8']
+
+    def test_invalidate_host(self):
+        cache = self.build_cache(['http://www.test.com/a',
+                                  'https://www.test.com:8443/b',
+                                  'http://other.com/a'])
+
+        assert cache.invalidate_host('www.test.com') == 2
+        assert list(cache._cache.keys()) == ['http://other.com/a']
+
+    def test_invalidate_tag(self):
+        cache = self.build_cache(['http://www.test.com/a'],
+                                 headers={'Surrogate-Key': 'user-7 users'})
+        other = MockRequestsResponse(url='http://www.test.com/b',
+                                     headers={'Cache-Control': 'max-age=3600',
+                                              'Cache-Tag': 'users, lists'})
+        cache.store(other)
+
+        assert cache.invalidate_tag('user-7') == 1
+        assert cache.invalidate_tag('users') == 1
+        assert len(cache._cache) == 0
+
+    def test_evicted_entries_leave_the_index(self):
+        cache = httpcache.HTTPCache(capacity=1)
+        for url in ('http://www.test.com/a', 'http://www.test.com/b'):
+            cache.store(MockRequestsResponse(url=url))
+
+        assert len(cache._index) == 1
+        assert cache.invalidate_host('www.test.com') == 1
+
+    def test_store_deletes_keep_recency_order(self):
+        store = httpcache.structures.RecentOrderedDict()
+        for key in 'abcde':
+            store[key] = key.upper()
+
+        store['b']
+        del store['c']
+        assert store.pop('d') == 'D'
+        assert store.pop('d', None) is None
+
+        assert store.keys() == ['a', 'e', 'b']
+        assert store.popitem(last=False) == ('a', 'A')
+        assert store.items() == [('e', 'E'), ('b', 'B')]
+
+
+class TestSweeping(object):
+    """
+    Tests for the removal of expired entries from the HTTPCache object.
+    """
+    def store_expired(self, cache, count):
+        for i in range(count):
+            resp = MockRequestsResponse(url='http://www.test.com/%d' % i)
+            entry = {'response': resp,
+                     'creation': datetime.utcnow() - timedelta(days=1),
+                     'expiry': datetime.utcnow() - timedelta(seconds=60)}
+            cache._insert(resp.url, entry)
+
+    def test_each_operation_sweeps_a_batch(self):
+        cache = httpcache.HTTPCache(capacity=100, sweep_batch=3)
+        self.store_expired(cache, 5)
+
+        cache.retrieve(MockRequestsPreparedRequest(url='http://www.test.com/x'))
+        assert len(cache._cache) == 2
+
+        cache.store(MockRequestsResponse(url='http://www.test.com/x'))
+        assert len(cache._cache) == 1
+
+    def test_sweep_removes_everything_expired(self):
+        cache = httpcache.HTTPCache(capacity=100, sweep_batch=0)
+        self.store_expired(cache, 5)
+        cache.store(MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'}))
+
+        assert cache.sweep() == 5
+        assert list(cache._cache.keys()) == ['http://www.test.com/']
+        assert len(cache._index) == 1
+
+    def test_eviction_prefers_expired_entries(self):
+        cache = httpcache.HTTPCache(capacity=3, sweep_batch=0)
+        speculative = MockRequestsResponse(url='http://www.test.com/speculative')
+        cache.store(speculative)
+        self.store_expired(cache, 2)
+
+        cache.store(MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'}))
+        cache.store(MockRequestsResponse(url='http://www.test.com/b',
+                                         headers={'Cache-Control': 'max-age=3600'}))
+
+        assert speculative.url in cache._cache
+        assert len(cache._cache) == 3
+
+    def test_background_sweeper(self):
+        cache = httpcache.HTTPCache(capacity=100, sweep_batch=0)
+        self.store_expired(cache, 5)
+
+        cache.start_sweeper(interval=0.01)
+        try:
+            deadline = datetime.utcnow() + timedelta(seconds=5)
+            while len(cache._cache) and datetime.utcnow() < deadline:
+                pass
+        finally:
+            cache.stop_sweeper()
+
+        assert len(cache._cache) == 0
+
+    def test_concurrent_sweeper_starts_run_one_thread(self):
+        cache = httpcache.HTTPCache()
+        starters = [threading.Thread(target=cache.start_sweeper)
+                    for _ in range(10)]
+
+        for starter in starters:
+            starter.start()
+        for starter in starters:
+            starter.join()
+
+        sweepers = [t for t in threading.enumerate()
+                    if t.name == 'httpcache-sweeper']
+        cache.stop_sweeper()
+
+        assert len(sweepers) == 1
+        assert not sweepers[0].is_alive()
+
+    def test_expiry_buckets_respect_limits(self):
+        buckets = httpcache.structures.ExpiryBuckets(granularity=10)
+        for i in range(5):
+            buckets.add(i, 100 + i)
+        buckets.add('later', 200)
+        buckets.remove(4)
+
+        first = buckets.pop_expired(150, limit=2)
+        rest = buckets.pop_expired(150)
+
+        assert len(first) == 2
+        assert sorted(first + rest) == [0, 1, 2, 3]
+        assert buckets.pop_expired(150) == []
+        assert buckets.pop_expired(200) == ['later']
+
+    def test_expiry_buckets_stay_bounded(self):
+        buckets = httpcache.structures.ExpiryBuckets(granularity=1)
+        for i in range(20000):
+            buckets.add('hot', 1000 + i)
+
+        assert len(buckets) == 1
+        assert len(buckets._heap) <= 100
+        assert buckets.pop_expired(100000) == ['hot']
+
+    def test_restoring_in_one_bucket_reuses_it(self):
+        buckets = httpcache.structures.ExpiryBuckets(granularity=10)
+        for _ in range(1000):
+            buckets.add('hot', 105)
+
+        assert len(buckets._heap) == 1
+
+
+class TestHeuristicFreshness(object):
+    """
+    Tests for heuristic freshness based on the Last-Modified header.
+    """
+    headers = {'Date': 'Sun, 06 Nov 2034 08:49:37 GMT',
+               'Last-Modified': 'Sun, 06 Nov 2033 08:49:37 GMT'}
+
+    def test_heuristic_is_fraction_of_age(self):
+        cache = httpcache.HTTPCache(heuristic_fraction=0.1,
+                                    heuristic_max_age=365 * 86400)
+        resp = MockRequestsResponse(headers=self.headers)
+
+        assert cache.store(resp)
+
+        expiry = cache._cache[resp.url]['expiry']
+        assert expiry == datetime(2034, 11, 6, 8, 49, 37) + timedelta(days=36.5)
+
+    def test_heuristic_is_capped(self):
+        cache = httpcache.HTTPCache(heuristic_max_age=60)
+        resp = MockRequestsResponse(headers=self.headers)
+
+        assert cache.store(resp)
+
+        expiry = cache._cache[resp.url]['expiry']
+        assert expiry == datetime(2034, 11, 6, 8, 50, 37)
+
+    def test_heuristically_fresh_responses_are_served(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers={'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'})
+        req = MockRequestsPreparedRequest(headers={})
+
+        assert cache.store(resp)
+        assert cache.retrieve(req) is resp
+        assert 'If-Modified-Since' not in req.headers
+
+    def test_heuristic_allows_caching_query_strings(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers=self.headers)
+        resp.url += '?a=b'
+
+        assert cache.store(resp)
+
+    def test_explicit_expires_wins(self):
+        cache = httpcache.HTTPCache()
+        headers = dict(self.headers)
+        headers['Expires'] = 'garbage'
+        resp = MockRequestsResponse(headers=headers)
+
+        assert cache.store(resp)
+        assert cache._cache[resp.url]['expiry'] is None
+
+    def test_heuristic_can_be_disabled(self):
+        for cache in (httpcache.HTTPCache(heuristic_fraction=0),
+                      httpcache.HTTPCache(heuristic_disabled_hosts=['WWW.test.com'])):
+            resp = MockRequestsResponse(headers=self.headers)
+
+            assert cache.store(resp)
+            assert cache._cache[resp.url]['expiry'] is None
+
+
+class TestNegativeCaching(object):
+    """
+    Tests for caching of error responses.
+    """
+    def test_errors_are_not_cached_by_default(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(status_code=404)
+
+        assert not cache.store(resp)
+
+    def test_errors_are_cached_for_their_ttl(self):
+        cache = httpcache.HTTPCache(negative_ttls={404: 30})
+        resp = MockRequestsResponse(status_code=404)
+        resp.content = b'Not Found'
+        req = MockRequestsPreparedRequest(headers={})
+
+        assert cache.store(resp)
+        cached_resp = cache.retrieve(req)
+
+        assert cached_resp.status_code == 404
+        assert cached_resp.content == b''
+        expiry = cache._cache[resp.url]['expiry']
+        assert timedelta(seconds=29) < expiry - datetime.utcnow() <= timedelta(seconds=30)
+
+    def test_errors_respect_cache_control(self):
+        cache = httpcache.HTTPCache(negative_ttls={503: 5})
+        no_store = MockRequestsResponse(status_code=503,
+                                        headers={'Cache-Control': 'no-store'})
+        longer = MockRequestsResponse(status_code=503,
+                                      url='http://www.test.com/a',
+                                      headers={'Cache-Control': 'max-age=60'})
+
+        assert not cache.store(no_store)
+        assert cache.store(longer)
+        expiry = cache._cache[longer.url]['expiry']
+        assert expiry - datetime.utcnow() > timedelta(seconds=55)
+
+    def test_error_ttls_are_bounded(self):
+        cache = httpcache.HTTPCache(negative_ttls={404: 30}, negative_max_ttl=10)
+        resp = MockRequestsResponse(status_code=404,
+                                    headers={'Cache-Control': 'max-age=3600'})
+
+        assert cache.store(resp)
+        expiry = cache._cache[resp.url]['expiry']
+        assert expiry - datetime.utcnow() <= timedelta(seconds=10)
+
+    def test_unlisted_errors_are_not_cached(self):
+        cache = httpcache.HTTPCache(negative_ttls=httpcache.cache.DEFAULT_NEGATIVE_TTLS)
+        resp = MockRequestsResponse(status_code=403)
+
+        assert not cache.store(resp)
+
+
+class TestRedirects(object):
+    """
+    Tests for shortcutting cached permanent redirects.
+    """
+    def store_redirect(self, cache, url, location, status_code=301):
+        resp = MockRequestsResponse(status_code=status_code, url=url,
+                                    headers={'Location': location})
+        assert cache.store(resp)
+
+    def test_redirect_resolves_to_cached_target(self):
+        cache = httpcache.HTTPCache()
+        target = MockRequestsResponse(url='http://www.test.com/new',
+                                      headers={'Cache-Control': 'max-age=3600'})
+        self.store_redirect(cache, 'http://www.test.com/old', '/new', 308)
+        cache.store(target)
+        req = MockRequestsPreparedRequest(url='http://www.test.com/old', headers={})
+
+        assert cache.retrieve(req) is target
+
+    def test_redirect_chains_collapse(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://www.test.com/b')
+        self.store_redirect(cache, 'http://www.test.com/b', 'https://www.test.com/c')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a', headers={})
+
+        assert cache.retrieve(req) is None
+        assert req.url == 'https://www.test.com/c'
+
+    def test_redirect_cycles_are_ignored(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://www.test.com/b')
+        self.store_redirect(cache, 'http://www.test.com/b', 'http://www.test.com/a')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a', headers={})
+
+        cache.retrieve(req)
+        assert req.url == 'http://www.test.com/a'
+
+    def test_credentials_are_not_sent_to_other_hosts(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://other.com/a')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a',
+                                          headers={'Authorization': 'secret'})
+
+        cache.retrieve(req)
+        assert req.url == 'http://other.com/a'
+        assert 'Authorization' not in req.headers
+
+    def test_all_credentials_are_stripped_for_other_hosts(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://other.com/a')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a',
+                                          headers={'Cookie': 'session=1',
+                                                   'Proxy-Authorization': 'secret'})
+
+        cache.retrieve(req)
+        assert req.url == 'http://other.com/a'
+        assert 'Cookie' not in req.headers
+        assert 'Proxy-Authorization' not in req.headers
+
+    def test_https_to_http_redirects_are_not_followed(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'https://www.test.com/a', 'http://evil.com/a')
+        req = MockRequestsPreparedRequest(url='https://www.test.com/a',
+                                          headers={'Cookie': 'session=1'})
+
+        cache.retrieve(req)
+        assert req.url == 'https://www.test.com/a'
+        assert req.headers['Cookie'] == 'session=1'
+
+    def test_no_cache_requests_are_not_redirected(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://www.test.com/b')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a',
+                                          headers={'Cache-Control': 'no-cache'})
+
+        cache.retrieve(req)
+        assert req.url == 'http://www.test.com/a'
+
+    def test_redirects_to_bypassed_urls_are_not_followed(self):
+        rule = httpcache.CacheRule(path='/b', bypass=True)
+        cache = httpcache.HTTPCache(rules=[rule])
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://www.test.com/b')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a', headers={})
+
+        cache.retrieve(req)
+        assert req.url == 'http://www.test.com/a'
+
+    def test_removed_redirects_are_not_followed(self):
+        cache = httpcache.HTTPCache()
+        self.store_redirect(cache, 'http://www.test.com/a', 'http://www.test.com/b')
+        cache.invalidate_host('www.test.com')
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a', headers={})
+
+        cache.retrieve(req)
+        assert req.url == 'http://www.test.com/a'
+
+    def test_expired_redirects_are_not_followed(self):
+        cache = httpcache.HTTPCache(sweep_batch=0)
+        resp = MockRequestsResponse(status_code=301,
+                                    url='http://www.test.com/a',
+                                    headers={'Location': '/b'})
+        cache._insert(resp.url, {'response': resp,
+                                 'creation': datetime.utcnow() - timedelta(days=1),
+                                 'expiry': datetime.utcnow() - timedelta(seconds=1)})
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a', headers={})
+
+        cache.retrieve(req)
+        assert req.url == 'http://www.test.com/a'
+
+
+class TestHeadRequests(object):
+    """
+    Tests for answering HEAD requests from cached GET responses.
+    """
+    def head_response(self, headers):
+        resp = MockRequestsResponse(headers=headers)
+        resp.request.method = 'HEAD'
+        return resp
+
+    def test_fresh_get_answers_head(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        resp.content = b'body'
+        cache.store(resp)
+        req = MockRequestsPreparedRequest(method='HEAD', headers={})
+
+        cached_resp = cache.retrieve(req)
+
+        assert cached_resp.status_code == 200
+        assert cached_resp.headers['Cache-Control'] == 'max-age=3600'
+        assert cached_resp.content == b''
+
+    def test_head_never_answers_get(self):
+        cache = httpcache.HTTPCache()
+        cache.store(self.head_response({'Cache-Control': 'max-age=3600'}))
+        req = MockRequestsPreparedRequest(headers={})
+
+        assert cache.retrieve(req) is None
+        assert cache.retrieve(MockRequestsPreparedRequest(method='HEAD',
+                                                          headers={})) is not None
+
+    def test_head_refreshes_get_metadata(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers={'ETag': '"a"'})
+        resp.content = b'body'
+        cache.store(resp)
+
+        head = self.head_response({'ETag': '"a"', 'Cache-Control': 'max-age=3600'})
+        assert cache.store(head)
+
+        assert list(cache._cache.keys()) == [resp.url]
+        cached_resp = cache.retrieve(MockRequestsPreparedRequest(headers={}))
+        assert cached_resp.content == b'body'
+        assert cached_resp.headers['Cache-Control'] == 'max-age=3600'
+        assert 'Cache-Control' not in resp.headers
+
+    def test_changed_validators_drop_get_body(self):
+        cache = httpcache.HTTPCache()
+        cache.store(MockRequestsResponse(headers={'ETag': '"a"'}))
+
+        head = self.head_response({'ETag': '"b"', 'Cache-Control': 'max-age=3600'})
+        assert cache.store(head)
+
+        assert list(cache._cache.keys()) == ['HEAD http://www.test.com/']
+
+    def test_head_redirect_drops_get(self):
+        cache = httpcache.HTTPCache()
+        cache.store(MockRequestsResponse(headers={'ETag': '"a"'}))
+
+        head = MockRequestsResponse(status_code=301,
+                                    headers={'Location': '/new',
+                                             'Cache-Control': 'max-age=600'})
+        head.request.method = 'HEAD'
+        assert cache.store(head)
+
+        assert list(cache._cache.keys()) == ['HEAD http://www.test.com/']
+        assert cache.retrieve(MockRequestsPreparedRequest(headers={})) is None
+
+    def test_negative_head_drops_get(self):
+        cache = httpcache.HTTPCache(negative_ttls={404: 60})
+        cache.store(MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'}))
+
+        head = MockRequestsResponse(status_code=404, headers={})
+        head.request.method = 'HEAD'
+        assert cache.store(head)
+
+        assert list(cache._cache.keys()) == ['HEAD http://www.test.com/']
+        assert cache.retrieve(MockRequestsPreparedRequest(headers={})) is None
+
+    def test_unsafe_methods_invalidate_all_methods(self):
+        cache = httpcache.HTTPCache()
+        cache.store(self.head_response({'Cache-Control': 'max-age=3600'}))
+        cache._cache['OPTIONS http://www.test.com/'] = cache._cache['HEAD http://www.test.com/']
+
+        cache.retrieve(MockRequestsPreparedRequest(method='PUT', headers={}))
+        assert len(cache._cache) == 0
+
+
+class TestBodyDeduplication(object):
+    """
+    Tests for deduplication of identical response bodies.
+    """
+    def store_body(self, cache, url, body):
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp.headers = requests.structures.CaseInsensitiveDict(
+            {'Cache-Control': 'max-age=3600'})
+        resp._content = body
+        resp.request = MockRequestsPreparedRequest(url=url)
+        assert cache.store(resp)
+        return resp
+
+    def test_identical_bodies_are_shared(self):
+        cache = httpcache.HTTPCache(dedupe_bodies=True)
+        body = b'x' * 1000
+        resp1 = self.store_body(cache, 'http://www.test.com/a', body)
+        resp2 = self.store_body(cache, 'http://www.test.com/b', b'x' * 1000)
+
+        assert resp1.content is resp2.content
+        assert cache.memory_usage() == {'bodies': 2000, 'stored': 1000}
+
+    def test_bodies_are_freed_with_their_last_entry(self):
+        cache = httpcache.HTTPCache(capacity=2, dedupe_bodies=True)
+        self.store_body(cache, 'http://www.test.com/a', b'a' * 10)
+        self.store_body(cache, 'http://www.test.com/b', b'a' * 10)
+        self.store_body(cache, 'http://www.test.com/c', b'c' * 10)
+
+        assert cache.memory_usage() == {'bodies': 20, 'stored': 20}
+
+        cache.invalidate_host('www.test.com')
+
+        assert cache.memory_usage() == {'bodies': 0, 'stored': 0}
+        assert len(cache._bodies) == 0
+
+    def test_replacing_an_entry_releases_its_body(self):
+        cache = httpcache.HTTPCache(dedupe_bodies=True)
+        self.store_body(cache, 'http://www.test.com/a', b'old')
+        self.store_body(cache, 'http://www.test.com/a', b'new!')
+
+        assert cache.memory_usage() == {'bodies': 4, 'stored': 4}
+
+    def test_memory_usage_without_deduplication(self):
+        cache = httpcache.HTTPCache()
+        self.store_body(cache, 'http://www.test.com/a', b'x' * 10)
+        self.store_body(cache, 'http://www.test.com/b', b'x' * 10)
+
+        assert cache.memory_usage() == {'bodies': 20, 'stored': 20}
+
+
+class TestCachePolicy(object):
+    """
+    Tests for per-host and per-route cache policy rules.
+    """
+    def test_rules_match_in_order(self):
+        policy = httpcache.policy.CachePolicy([
+            httpcache.CacheRule(host='api.test.com', path='/v1/*', ttl=1),
+            httpcache.CacheRule(host='*.test.com', ttl=2),
+            httpcache.CacheRule(path='/static/*', ttl=3),
+        ])
+
+        assert policy.match('http://api.test.com/v1/users').ttl == 1
+        assert policy.match('http://API.test.com/v2/users').ttl == 2
+        assert policy.match('http://other.com/static/a.css').ttl == 3
+        assert policy.match('http://other.com/dynamic') is None
+
+    def test_forced_ttl_overrides_no_cache(self):
+        cache = httpcache.HTTPCache(rules=[httpcache.CacheRule(host='www.test.com', ttl=30)])
+        resp = MockRequestsResponse(headers={'Cache-Control': 'no-cache'})
+
+        assert cache.store(resp)
+        expiry = cache._cache[resp.url]['expiry']
+        assert timedelta(seconds=29) < expiry - datetime.utcnow() <= timedelta(seconds=30)
+
+    def test_max_ttl_clamps_max_age(self):
+        cache = httpcache.HTTPCache(rules=[httpcache.CacheRule(max_ttl=60)])
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=86400'})
+
+        assert cache.store(resp)
+        expiry = cache._cache[resp.url]['expiry']
+        assert expiry - datetime.utcnow() <= timedelta(seconds=60)
+
+    def test_min_ttl_makes_responses_fresh(self):
+        cache = httpcache.HTTPCache(rules=[httpcache.CacheRule(min_ttl=60)])
+        resp = MockRequestsResponse()
+        req = MockRequestsPreparedRequest(headers={})
+
+        assert cache.store(resp)
+        assert cache.retrieve(req) is resp
+
+    def test_bypass(self):
+        cache = httpcache.HTTPCache(rules=[httpcache.CacheRule(path='/private/*',
+                                                               bypass=True)])
+        resp = MockRequestsResponse(url='http://www.test.com/private/a',
+                                    headers={'Cache-Control': 'max-age=60'})
+        req = MockRequestsPreparedRequest(url=resp.url, headers={})
+
+        assert not cache.store(resp)
+
+        cache._cache[resp.url] = {'response': resp,
+                                  'creation': datetime.utcnow(),
+                                  'expiry': datetime.utcnow() + timedelta(seconds=60)}
+        assert cache.retrieve(req) is None
+        assert cache.retrieve_many([req]) == ([], [req], [])
+
+    def test_max_size(self):
+        cache = httpcache.HTTPCache(rules=[httpcache.CacheRule(max_size=4)])
+        small = MockRequestsResponse(url='http://www.test.com/small')
+        small.content = b'abcd'
+        large = MockRequestsResponse(url='http://www.test.com/large')
+        large.content = b'abcde'
+
+        assert cache.store(small)
+        assert not cache.store(large)
+
+    def test_rules_can_disable_heuristics(self):
+        cache = httpcache.HTTPCache(rules=[httpcache.CacheRule(host='www.test.com',
+                                                               heuristic=False)])
+        resp = MockRequestsResponse(headers={'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'})
+
+        assert cache.store(resp)
+        assert cache._cache[resp.url]['expiry'] is None
+
+    def test_remembered_hosts_are_bounded(self):
+        policy = httpcache.policy.CachePolicy([httpcache.CacheRule(host='*.test.com',
+                                                                   ttl=60)],
+                                              max_hosts=10)
+        for i in range(100):
+            policy.match('http://host%d.test.com/' % i)
+
+        assert len(policy._candidates) == 10
+        assert policy.match('http://host0.test.com/').ttl == 60
+
+
+class TestRequestDirectives(object):
+    """
+    Tests for the Cache-Control directives sent on requests.
+    """
+    def store_entry(self, cache, age, lifetime):
+        resp = MockRequestsResponse()
+        now = datetime.utcnow()
+        cache._insert(resp.url, {'response': resp,
+                                 'creation': now - timedelta(seconds=age),
+                                 'expiry': now + timedelta(seconds=lifetime)})
+        return resp
+
+    def request(self, cache_control):
+        return MockRequestsPreparedRequest(headers={'Cache-Control': cache_control})
+
+    def test_max_stale_serves_stale_entries(self):
+        cache = httpcache.HTTPCache(stale_retention=300)
+        resp = self.store_entry(cache, 100, -30)
+
+        assert cache.retrieve(self.request('max-stale=60')) is resp
+        assert cache.retrieve(self.request('max-stale')) is resp
+        assert cache.retrieve(self.request('max-stale=10')) is None
+        assert resp.url in cache._cache
+
+    def test_stale_entries_are_revalidated(self):
+        cache = httpcache.HTTPCache(stale_retention=300)
+        self.store_entry(cache, 100, -30)
+        req = MockRequestsPreparedRequest(headers={})
+
+        assert cache.retrieve(req) is None
+        assert 'If-Modified-Since' in req.headers
+
+    def test_min_fresh(self):
+        cache = httpcache.HTTPCache()
+        resp = self.store_entry(cache, 0, 60)
+
+        assert cache.retrieve(self.request('min-fresh=30')) is resp
+        assert cache.retrieve(self.request('min-fresh=90')) is None
+
+    def test_max_age(self):
+        cache = httpcache.HTTPCache()
+        resp = self.store_entry(cache, 100, 60)
+
+        assert cache.retrieve(self.request('max-age=200')) is resp
+        req = self.request('max-age=50')
+        assert cache.retrieve(req) is None
+        assert 'If-Modified-Since' in req.headers
+
+    def test_no_cache_skips_the_cache(self):
+        cache = httpcache.HTTPCache()
+        self.store_entry(cache, 0, 60)
+        req = self.request('no-cache')
+
+        assert cache.retrieve(req) is None
+        assert 'If-Modified-Since' not in req.headers
+
+    def test_only_if_cached(self):
+        cache = httpcache.HTTPCache()
+        resp = self.store_entry(cache, 0, 60)
+
+        assert cache.retrieve(self.request('only-if-cached')) is resp
+
+        req = self.request('only-if-cached')
+        req.url += 'missing'
+        cached_resp = cache.retrieve(req)
+        assert cached_resp.status_code == 504
+        assert cached_resp.request is req
+
+    def test_only_if_cached_in_batches(self):
+        cache = httpcache.HTTPCache()
+        req = self.request('only-if-cached')
+
+        hits, misses, conditionals = cache.retrieve_many([req])
+
+        assert hits[0][1].status_code == 504
+        assert misses == conditionals == []
+
+    def test_only_if_cached_on_bypassed_urls(self):
+        rule = httpcache.CacheRule(host='www.test.com', bypass=True)
+        cache = httpcache.HTTPCache(rules=[rule])
+
+        assert cache.retrieve(self.request('only-if-cached')).status_code == 504
+
+        hits, misses, conditionals = cache.retrieve_many(
+            [self.request('only-if-cached')])
+        assert hits[0][1].status_code == 504
+        assert misses == conditionals == []
+
+
+class TestMemoryController(object):
+    """
+    Tests for adapting the capacity of the HTTPCache to memory pressure.
+    """
+    def build(self, pressure, **kwargs):
+        readings = [pressure]
+        kwargs.setdefault('interval', 0)
+        controller = httpcache.MemoryController(
+            sampler=lambda: (readings[0] * 1000, 1000), **kwargs)
+        return controller, readings
+
+    def fill(self, cache, count):
+        for i in range(count):
+            cache.store(MockRequestsResponse(url='http://www.test.com/%d' % i))
+
+    def test_capacity_shrinks_under_pressure(self):
+        controller, _ = self.build(0.95, min_capacity=10, max_capacity=100,
+                                   shrink_factor=0.5)
+        cache = httpcache.HTTPCache(capacity=100, memory_controller=controller)
+
+        cache.retrieve(MockRequestsPreparedRequest(headers={}))
+        assert cache.capacity == 50
+        cache.retrieve(MockRequestsPreparedRequest(headers={}))
+        assert cache.capacity == 25
+
+        for _ in range(5):
+            cache.retrieve(MockRequestsPreparedRequest(headers={}))
+        assert cache.capacity == 10
+        assert controller.metrics['shrinks'] == 4
+
+    def test_capacity_grows_without_pressure(self):
+        controller, _ = self.build(0.1, min_capacity=10, max_capacity=12,
+                                   grow_factor=1.1)
+        cache = httpcache.HTTPCache(capacity=10, memory_controller=controller)
+
+        for _ in range(5):
+            cache.retrieve(MockRequestsPreparedRequest(headers={}))
+
+        assert cache.capacity == 12
+        assert controller.metrics['grows'] == 2
+        assert controller.metrics['capacity'] == 12
+
+    def test_evictions_happen_in_batches(self):
+        controller, readings = self.build(0.1, min_capacity=10, max_capacity=100,
+                                          shrink_factor=0.5, batch_size=20)
+        cache = httpcache.HTTPCache(capacity=100, memory_controller=controller)
+        self.fill(cache, 100)
+        assert len(cache._cache) == 100
+
+        readings[0] = 0.95
+        cache.retrieve(MockRequestsPreparedRequest(headers={}))
+        assert cache.capacity == 50
+        assert len(cache._cache) == 80
+
+        readings[0] = 0.7
+        cache.retrieve(MockRequestsPreparedRequest(headers={}))
+        assert len(cache._cache) == 60
+        assert controller.metrics['evictions'] == 40
+
+    def test_samples_are_rate_limited(self):
+        controller, _ = self.build(0.95, min_capacity=10, max_capacity=100,
+                                   interval=3600)
+        cache = httpcache.HTTPCache(capacity=100, memory_controller=controller)
+
+        for _ in range(5):
+            cache.retrieve(MockRequestsPreparedRequest(headers={}))
+
+        assert controller.metrics['samples'] == 1
+
+    def test_default_sampler(self):
+        usage, limit = httpcache.memory.sample_memory()
+
+        assert usage is None or 0 < usage
+        assert limit is None or 0 < limit
+
+
+class TestPrivatePartitions(object):
+    """
+    Tests for caching responses to requests with credentials in per-principal
+    partitions.
+    """
+    def private_response(self, credentials, url='http://www.test.com/'):
+        resp = MockRequestsResponse(url=url,
+                                    headers={'Cache-Control': 'private, max-age=3600'})
+        resp.request = MockRequestsPreparedRequest(
+            url=url, headers={'Authorization': credentials})
+        return resp
+
+    def private_request(self, credentials, url='http://www.test.com/'):
+        return MockRequestsPreparedRequest(url=url,
+                                           headers={'Authorization': credentials})
+
+    def test_principals_only_see_their_own_entries(self):
+        cache = httpcache.HTTPCache(private_mode=True)
+        alice = self.private_response('Basic alice')
+        assert cache.store(alice)
+
+        assert cache.retrieve(self.private_request('Basic alice')) is alice
+        assert cache.retrieve(self.private_request('Basic bob')) is None
+        assert cache.retrieve(MockRequestsPreparedRequest(headers={})) is None
+
+    def test_credentials_are_not_stored_in_keys(self):
+        cache = httpcache.HTTPCache(private_mode=True)
+        cache.store(self.private_response('Basic alice'))
+
+        key = list(cache._cache.keys())[0]
+        assert 'alice' not in key
+        assert key.startswith('private:')
+
+    def test_partitions_have_quotas(self):
+        cache = httpcache.HTTPCache(private_mode=True, partition_capacity=2)
+        for i in range(3):
+            url = 'http://www.test.com/%d' % i
+            cache.store(self.private_response('Basic alice', url))
+        cache.store(self.private_response('Basic bob'))
+
+        assert len(cache._cache) == 3
+        assert cache.retrieve(self.private_request('Basic alice',
+                                                   'http://www.test.com/0')) is None
+        assert cache.retrieve(self.private_request('Basic alice',
+                                                   'http://www.test.com/2')) is not None
+
+    def test_unsafe_methods_invalidate_private_entries(self):
+        cache = httpcache.HTTPCache(private_mode=True)
+        cache.store(self.private_response('Basic alice'))
+        req = MockRequestsPreparedRequest(method='POST', headers={})
+
+        cache.retrieve(req)
+        assert len(cache._cache) == 0
+        assert cache._partitions == {}
+
+    def test_private_responses_without_credentials_are_not_stored(self):
+        cache = httpcache.HTTPCache(private_mode=True)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'private, max-age=3600'})
+        resp.request = MockRequestsPreparedRequest(headers={})
+
+        assert not cache.store(resp)
+        assert len(cache._cache) == 0
+
+    def test_shared_caches_only_store_partitioned_private_responses(self):
+        backend = httpcache.structures.RecentOrderedDict()
+        cache = httpcache.HTTPCache(backend=backend)
+        public = MockRequestsResponse(url='http://www.test.com/public',
+                                      headers={'Cache-Control': 'max-age=3600'})
+
+        assert not cache.store(self.private_response('Basic alice'))
+        assert cache.store(public)
+
+        cache = httpcache.HTTPCache(backend=backend, private_mode=True)
+        assert cache.store(self.private_response('Basic alice'))
+
+    def test_named_shared_caches_do_not_store_private_responses(self):
+        cache = httpcache.shared_cache('test-private-responses')
+
+        assert not cache.store(self.private_response('Basic alice'))
+
+    def test_snapshots_leave_out_unrecoverable_partitions(self):
+        cache = httpcache.HTTPCache(private_mode=True)
+        cache.store(self.private_response('Basic alice'))
+        cache.store(MockRequestsResponse(url='http://www.test.com/public',
+                                         headers={'Cache-Control': 'max-age=3600'}))
+
+        snapshot = io.BytesIO()
+        assert cache.dump(snapshot) == 1
+        assert b'private:' not in snapshot.getvalue()
+
+    def test_snapshots_keep_partitions_with_a_secret(self):
+        cache = httpcache.HTTPCache(private_mode=True, partition_secret=b'key')
+        cache.store(self.private_response('Basic alice'))
+
+        snapshot = io.BytesIO()
+        assert cache.dump(snapshot) == 1
+
+        snapshot.seek(0)
+        new_cache = httpcache.HTTPCache(private_mode=True,
+                                        partition_secret=b'key')
+        assert new_cache.load(snapshot) == 1
+        assert new_cache.retrieve(self.private_request('Basic alice')) is not None
+
+    def test_private_mode_is_off_by_default(self):
+        cache = httpcache.HTTPCache()
+        resp = self.private_response('Basic alice')
+        cache.store(resp)
+
+        assert list(cache._cache.keys()) == [resp.url]
+
+
+class TestEvictionPolicies(object):
+    """
+    Tests for the pluggable eviction policies and the trace simulator.
+    """
+    def fresh_response(self, url):
+        return MockRequestsResponse(url=url,
+                                    headers={'Cache-Control': 'max-age=3600'})
+
+    def test_lru_evicts_least_recently_used(self):
+        policy = httpcache.eviction.LRUPolicy(3)
+        for key in 'abc':
+            policy.insert(key)
+        policy.access('a')
+
+        assert policy.evict() == 'b'
+        assert len(policy) == 2
+
+    def test_slru_protects_reused_keys(self):
+        policy = httpcache.eviction.SLRUPolicy(4)
+        policy.insert('hot')
+        policy.access('hot')
+        for key in 'abc':
+            policy.insert(key)
+
+        assert [policy.evict() for _ in range(3)] == ['a', 'b', 'c']
+        assert policy.evict() == 'hot'
+        assert policy.evict() is None
+
+    def test_arc_remembers_evicted_keys(self):
+        policy = httpcache.eviction.ARCPolicy(2)
+        policy.insert('a')
+        policy.insert('b')
+        assert policy.evict() == 'a'
+
+        # A key found in the ghost list goes straight to the frequent list.
+        policy.insert('a')
+        assert 'a' in policy._t2
+        assert policy._p > 0
+
+    def test_lfu_evicts_least_frequently_used(self):
+        policy = httpcache.eviction.LFUPolicy(3)
+        for key in 'abc':
+            policy.insert(key)
+        policy.access('a')
+        policy.access('a')
+        policy.access('c')
+
+        assert policy.evict() == 'b'
+        assert policy.evict() == 'c'
+
+    def test_lfu_ages_out_old_favourites(self):
+        policy = httpcache.eviction.LFUPolicy(2)
+        policy.insert('old')
+        for _ in range(3):
+            policy.access('old')
+
+        for i in range(6):
+            policy.insert(i)
+            policy.access(i)
+            if len(policy) > 2:
+                policy.evict()
+
+        assert 'old' not in policy
+
+    def test_removed_keys_are_not_evicted(self):
+        for name in httpcache.eviction.POLICIES:
+            policy = httpcache.eviction.make_policy(name, 3)
+            policy.insert('a')
+            policy.insert('b')
+            policy.remove('a')
+
+            assert policy.evict() == 'b'
+            assert policy.evict() is None
+
+    def test_policies_handle_unbounded_caches(self):
+        for name in httpcache.eviction.POLICIES:
+            cache = httpcache.HTTPCache(capacity=None, eviction_policy=name)
+            cache.store(self.fresh_response('http://www.test.com/a'))
+            req = MockRequestsPreparedRequest(url='http://www.test.com/a',
+                                              headers={})
+
+            assert cache.retrieve(req) is not None
+            assert cache.retrieve(req) is not None
+
+            policy = httpcache.eviction.make_policy(name, None)
+            for key in 'abc':
+                policy.insert(key)
+                policy.access(key)
+            assert policy.evict() is not None
+            policy.insert('a')
+
+    def test_unknown_policies_are_rejected(self):
+        with pytest.raises(ValueError):
+            httpcache.HTTPCache(eviction_policy='random')
+
+    def test_cache_uses_policy(self):
+        cache = httpcache.HTTPCache(capacity=2, eviction_policy='lfu')
+        for path in ('a', 'b'):
+            cache.store(self.fresh_response('http://www.test.com/' + path))
+
+        req = MockRequestsPreparedRequest(url='http://www.test.com/a', headers={})
+        assert cache.retrieve(req) is not None
+        assert cache.retrieve(req) is not None
+
+        cache.store(self.fresh_response('http://www.test.com/c'))
+
+        assert set(cache._cache.keys()) == set(['http://www.test.com/a',
+                                                'http://www.test.com/c'])
+        assert len(cache.eviction_policy) == 2
+
+    def test_policy_forgets_invalidated_entries(self):
+        cache = httpcache.HTTPCache(eviction_policy='slru')
+        cache.store(self.fresh_response('http://www.test.com/a'))
+        cache.invalidate_host('www.test.com')
+
+        assert len(cache.eviction_policy) == 0
+
+    def test_simulate_counts_hits_and_bytes(self):
+        trace = [('a', 100, None), ('b', 10, None), ('a', 100, None),
+                 ('c', 10, None), ('b', 10, None)]
+        stats = httpcache.eviction.simulate(trace, 'lru', 2)
+
+        assert stats['requests'] == 5
+        assert stats['hits'] == 1
+        assert stats['misses'] == 4
+        assert stats['evictions'] == 2
+        assert stats['hit_ratio'] == 0.2
+        assert stats['byte_hit_ratio'] == 100.0 / 230
+
+    def test_simulate_expires_entries(self):
+        trace = [(0, 'a', 1, 10), (5, 'a', 1, 10), (20, 'a', 1, 10),
+                 (21, 'b', 1, 0), (22, 'b', 1, 0)]
+        stats = httpcache.eviction.simulate(trace, 'arc', 10)
+
+        assert stats['hits'] == 1
+        assert stats['expired'] == 1
+        assert stats['misses'] == 4
+
+    def test_compare_replays_every_policy(self):
+        # A popular key interleaved with a scan of one-off keys.
+        trace = [('hot', 1, None)] * 3
+        for i in range(50):
+            trace.append(('scan-%d' % i, 1, None))
+            trace.append(('scan-%d-again' % i, 1, None))
+            trace.append(('hot', 1, None))
+
+        results = httpcache.eviction.compare(trace, 2)
+
+        assert sorted(results) == ['arc', 'lfu', 'lru', 'slru']
+        assert results['lru']['hits'] == 2
+        for name in ('arc', 'lfu', 'slru'):
+            assert results[name]['hits'] == 52
+
+
+class TestMemoizedPayloads(object):
+    """
+    Tests for memoizing the decoded text and parsed JSON of cached responses.
+    """
+    def json_response(self, url='http://www.test.com/', body=b'{"a": [1, 2]}'):
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp.encoding = 'utf-8'
+        resp.headers = requests.structures.CaseInsensitiveDict(
+            {'Cache-Control': 'max-age=3600'})
+        resp._content = body
+        resp.request = MockRequestsPreparedRequest(url=url, headers={})
+        return resp
+
+    def hit(self, cache, url='http://www.test.com/'):
+        return cache.retrieve(MockRequestsPreparedRequest(url=url, headers={}))
+
+    def test_json_is_parsed_once(self):
+        cache = httpcache.HTTPCache(memoize_payloads='readonly')
+        cache.store(self.json_response())
+
+        first = self.hit(cache).json()
+        assert self.hit(cache).json() is first
+        assert first == {'a': [1, 2]}
+        assert self.hit(cache).text is self.hit(cache).text
+
+    def test_readonly_json_cannot_be_changed(self):
+        cache = httpcache.HTTPCache(memoize_payloads='readonly')
+        cache.store(self.json_response())
+
+        with pytest.raises(TypeError):
+            self.hit(cache).json()['b'] = 1
+
+    def test_readonly_lists_are_lists(self):
+        cache = httpcache.HTTPCache(memoize_payloads='readonly')
+        cache.store(self.json_response())
+        items = self.hit(cache).json()['a']
+
+        assert isinstance(items, list)
+        with pytest.raises(TypeError):
+            items.append(3)
+
+    def test_memos_are_bounded(self):
+        body = b'[' + b','.join([b'1'] * 50000) + b']'
+        cache = httpcache.HTTPCache(memoize_payloads='readonly',
+                                    memo_max_size=1024)
+        cache.store(self.json_response(body=body))
+
+        cached = self.hit(cache)
+        assert cached.json() is not cached.json()
+        assert cached.memo_size <= 1024
+
+        cache = httpcache.HTTPCache(memoize_payloads='readonly')
+        cache.store(self.json_response())
+        cached = self.hit(cache)
+        assert cached.memo_budget == httpcache.cache.MIN_MEMO_BUDGET
+
+    def test_copy_mode_returns_copies(self):
+        cache = httpcache.HTTPCache(memoize_payloads='copy')
+        cache.store(self.json_response())
+
+        first = self.hit(cache).json()
+        first['a'].append(3)
+
+        assert self.hit(cache).json() == {'a': [1, 2]}
+
+    def test_memoization_is_off_by_default(self):
+        cache = httpcache.HTTPCache()
+        resp = self.json_response()
+        cache.store(resp)
+
+        assert self.hit(cache) is resp
+        assert 'memos' not in cache.memory_usage()
+
+    def test_bad_modes_are_rejected(self):
+        with pytest.raises(ValueError):
+            httpcache.HTTPCache(memoize_payloads='always')
+
+    def test_memos_count_towards_memory_usage(self):
+        cache = httpcache.HTTPCache(memoize_payloads='readonly')
+        cache.store(self.json_response())
+        assert cache.memory_usage()['memos'] == 0
+
+        self.hit(cache).json()
+        assert cache.memory_usage()['memos'] > 0
+
+    def test_memos_respect_rule_size_limit(self):
+        rule = httpcache.CacheRule(host='www.test.com', max_size=20)
+        cache = httpcache.HTTPCache(memoize_payloads='readonly', rules=[rule])
+        cache.store(self.json_response())
+
+        cached = self.hit(cache)
+        assert cached.json() == {'a': [1, 2]}
+        assert cached.json() is not cached.json()
+        assert cached.memo_size <= 20 - len(cached.content)
+
+    def test_memos_are_dropped_on_revalidation(self):
+        cache = httpcache.HTTPCache(memoize_payloads='readonly')
+        cache.store(self.json_response())
+        cached = self.hit(cache)
+        cached.json()
+
+        resp = MockRequestsResponse(status_code=304, headers={})
+        assert cache.handle_304(resp) is cached
+        assert cached.memo_size == 0
+
+    def test_memos_are_dropped_on_eviction(self):
+        cache = httpcache.HTTPCache(capacity=1, memoize_payloads='readonly')
+        cache.store(self.json_response())
+        cached = self.hit(cache)
+        cached.json()
+
+        cache.store(self.json_response(url='http://www.test.com/other'))
+
+        assert cached.memo_size == 0
+        assert list(cache._memoized) == ['http://www.test.com/other']
+
+    def test_memos_are_not_pickled(self):
+        cache = httpcache.HTTPCache(memoize_payloads='copy')
+        cache.store(self.json_response())
+        cached = self.hit(cache)
+        cached.json()
+
+        restored = pickle.loads(pickle.dumps(cached))
+        assert restored.memo_size == 0
+        assert restored.memo_mode == 'copy'
+        assert restored.json() == {'a': [1, 2]}
+
+
+class TestRedisBackend(object):
+    """
+    Tests for the Redis-protocol cache backend, run against a fake server.
+    """
+    def test_can_store_and_retrieve_through_backend(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server, near_cache_size=0)
+        cache = httpcache.HTTPCache(capacity=None, backend=backend)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        req = MockRequestsPreparedRequest()
+
+        assert cache.store(resp)
+        cached_resp = cache.retrieve(req)
+
+        assert cached_resp.url == resp.url
+        assert 'httpcache:' + resp.url in server.data
+
+    def test_caches_on_backends_are_unbounded_by_default(self):
+        backend = httpcache.RedisBackend(client=FakeRedis())
+
+        assert httpcache.HTTPCache(backend=backend).capacity is None
+        assert httpcache.HTTPCache(backend=backend, capacity=10).capacity == 10
+        assert httpcache.HTTPCache().capacity == 50
+
+    def test_expiry_becomes_server_ttl(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server)
+        cache = httpcache.HTTPCache(capacity=None, backend=backend)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+
+        assert cache.store(resp)
+
+        ttl = server.ttls['httpcache:' + resp.url]
+        assert 3590 < ttl <= 3601
+
+    def test_server_ttl_includes_stale_retention(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server)
+        cache = httpcache.HTTPCache(backend=backend, stale_retention=600)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=60'})
+
+        assert backend.grace == 600
+        assert cache.store(resp)
+
+        ttl = server.ttls['httpcache:' + resp.url]
+        assert 650 < ttl <= 661
+
+    def test_stale_entries_are_kept_on_the_server(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server)
+        cache = httpcache.HTTPCache(backend=backend, stale_retention=600)
+        expiry = datetime.utcnow() - timedelta(seconds=30)
+
+        cache._cache['a'] = {'response': None, 'creation': None, 'expiry': expiry}
+
+        assert 'httpcache:a' in server.data
+        assert 560 < server.ttls['httpcache:a'] <= 571
+
+    def test_entries_without_expiry_get_default_ttl(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server, default_ttl=60)
+        cache = httpcache.HTTPCache(capacity=None, backend=backend)
+        resp = MockRequestsResponse()
+
+        assert cache.store(resp)
+        assert server.ttls['httpcache:' + resp.url] == 60
+
+    def test_near_cache_avoids_round_trips(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server)
+        entry = {'response': None, 'creation': None, 'expiry': None}
+
+        backend['a'] = entry
+        calls = server.calls
+        backend['a']
+
+        assert server.calls == calls
+
+    def test_get_many_uses_one_round_trip(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server, near_cache_size=0)
+
+        backend.set_many(dict((str(i), {'expiry': None}) for i in range(10)))
+        calls = server.calls
+        found = backend.get_many([str(i) for i in range(12)])
+
+        assert server.calls == calls + 1
+        assert len(found) == 10
+
+    def test_can_delete_entries(self):
+        server = FakeRedis()
+        backend = httpcache.RedisBackend(client=server)
+
+        backend['a'] = {'expiry': None}
+        del backend['a']
+
+        assert 'a' not in backend
+        assert len(backend) == 0
+
+
 class TestCachingHTTPAdapter(object):
     """
     Tests for the caching HTTP adapter.
@@ -285,6 +1738,71 @@ class TestCachingHTTPAdapter(object):
         assert r1 is not r2
 
 
+class TestSharedCaches(object):
+    """
+    Tests for sharing one cache between adapters and sessions.
+    """
+    def test_adapters_can_share_a_cache(self):
+        cache = httpcache.HTTPCache()
+        http = httpcache.CachingHTTPAdapter(cache=cache)
+        https = httpcache.CachingHTTPAdapter(cache=cache)
+
+        assert http.cache is https.cache is cache
+
+    def test_adapters_can_share_a_named_cache(self):
+        adapter1 = httpcache.CachingHTTPAdapter(cache='test-named', capacity=7)
+        adapter2 = httpcache.CachingHTTPAdapter(cache='test-named', capacity=99)
+
+        assert adapter1.cache is adapter2.cache
+        assert adapter1.cache is httpcache.shared_cache('test-named')
+        assert adapter1.cache.capacity == 7
+
+    def test_adapters_have_their_own_cache_by_default(self):
+        adapter1 = httpcache.CachingHTTPAdapter()
+        adapter2 = httpcache.CachingHTTPAdapter()
+
+        assert adapter1.cache is not adapter2.cache
+
+    def test_adapter_can_use_a_backend(self):
+        backend = httpcache.RedisBackend(client=FakeRedis())
+        adapter = httpcache.CachingHTTPAdapter(capacity=None, backend=backend)
+
+        assert adapter.cache._cache is backend
+
+    def test_backends_default_to_unbounded_capacity(self):
+        backend = httpcache.RedisBackend(client=FakeRedis())
+        adapter = httpcache.CachingHTTPAdapter(backend=backend)
+
+        assert adapter.cache.capacity is None
+        assert httpcache.CachingHTTPAdapter().cache.capacity == 50
+
+    def test_adapters_with_one_backend_share_a_cache(self):
+        backend = httpcache.RedisBackend(client=FakeRedis())
+        adapter1 = httpcache.CachingHTTPAdapter(backend=backend)
+        adapter2 = httpcache.CachingHTTPAdapter(backend=backend)
+
+        assert adapter1.cache is adapter2.cache
+
+    def test_adapters_sharing_a_backend_must_agree_on_capacity(self):
+        backend = httpcache.RedisBackend(client=FakeRedis())
+        adapter = httpcache.CachingHTTPAdapter(capacity=10, backend=backend)
+
+        assert httpcache.CachingHTTPAdapter(backend=backend).cache is adapter.cache
+
+        with pytest.raises(ValueError):
+            httpcache.CachingHTTPAdapter(capacity=20, backend=backend)
+
+    def test_backends_are_freed_with_their_adapters(self):
+        backend = httpcache.RedisBackend(client=FakeRedis())
+        adapter = httpcache.CachingHTTPAdapter(backend=backend)
+        backend_ref = weakref.ref(backend)
+
+        del adapter, backend
+        gc.collect()
+
+        assert backend_ref() is None
+
+
 class MockRequestsResponse(object):
     """
     A specially-designed Mock object that emulates the behaviour of the
@@ -317,3 +1835,76 @@ class MockRequestsPreparedRequest(object):
         self.headers = headers
         self.body = body
         self.url = url
+
+
+class FakeRedis(object):
+    """
+    An in-memory stand-in for a ``redis.StrictRedis`` client, implementing the
+    subset of commands used by the RedisBackend. Counts round-trips.
+    """
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.calls += 1
+        self._set(key, value, ex)
+        return True
+
+    def _set(self, key, value, ex):
+        self.data[key] = value
+        self.ttls[key] = ex
+
+    def delete(self, *keys):
+        self.calls += 1
+        return self._delete(keys)
+
+    def _delete(self, keys):
+        count = 0
+        for key in keys:
+            if key in self.data:
+                del self.data[key]
+                del self.ttls[key]
+                count += 1
+        return count
+
+    def exists(self, key):
+        self.calls += 1
+        return key in self.data
+
+    def scan_iter(self, match=None):
+        self.calls += 1
+        prefix = match.rstrip('*')
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline(object):
+    """
+    A pipeline for the FakeRedis client. Commands are queued and run in a
+    single round-trip on execute().
+    """
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        self.commands.append(lambda: self.client._set(key, value, ex))
+
+    def delete(self, *keys):
+        self.commands.append(lambda: self.client._delete(keys))
+
+    def execute(self):
+        self.client.calls += 1
+        return [command() for command in self.commands]